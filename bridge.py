@@ -1,4 +1,4 @@
-import requests, json, os, time, argparse
+import requests, json, os, time, argparse, threading, queue, concurrent.futures
 from logger import logger, set_logger_verbosity, quiesce_logger, test_logger
 
 import random
@@ -25,6 +25,9 @@ except:
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument('-i', '--interval', action="store", required=False, type=int, default=1, help="The amount of seconds with which to check if there's new prompts to generate")
+arg_parser.add_argument('-w', '--pop_wait', action="store", required=False, type=int, default=10, help="The amount of seconds the horde can hold our request until a new prompt arrives. Set to 0 to simply check every interval instead")
+arg_parser.add_argument('-p', '--pipeline_depth', action="store", required=False, type=int, default=0, help="If above 0, we will pick up to this many prompts ahead of time and submit asynchronously, so that the KAI instance never waits on the horde")
+arg_parser.add_argument('-f', '--fleet', action="store", required=False, type=str, help="A json file listing the kai_name and kai_url of multiple KAI instances. If specified, this bridge will drive all of them, instead of the single --kai_url")
 arg_parser.add_argument('-a', '--api_key', action="store", required=False, type=str, help="The API key corresponding to the owner of the KAI instance")
 arg_parser.add_argument('-n', '--kai_name', action="store", required=False, type=str, help="The server name. It will be shown to the world and there can be only one.")
 arg_parser.add_argument('-k', '--kai_url', action="store", required=False, type=str, help="The KoboldAI server URL. Where the bridge will get its generations from.")
@@ -35,63 +38,128 @@ arg_parser.add_argument('-v', '--verbosity', action='count', default=0, help="Th
 arg_parser.add_argument('-q', '--quiet', action='count', default=0, help="The default logging level is ERROR or higher. This value decreases the amount of logging seen in your screen")
 arg_parser.add_argument('--log_file', action='store_true', default=False, help="If specified will dump the log to the specified file")
 
-model = ''
-max_content_length = 1024
-max_length = 80
-current_softprompt = None
-softprompts = {}
-
-@logger.catch
-def validate_kai(kai):
-    global model
-    global max_content_length
-    global max_length
-    global softprompts
-    global current_softprompt
-    try:
-        req = requests.get(kai + '/api/latest/model')
-        model = req.json()["result"]
-        req = requests.get(kai + '/api/latest/config/max_context_length')
-        max_content_length = req.json()["value"]
-        req = requests.get(kai + '/api/latest/config/max_length')
-        max_length = req.json()["value"]
-        if model not in softprompts:
-                req = requests.get(kai + '/api/latest/config/soft_prompts_list')
-                softprompts[model] = [sp['value'] for sp in req.json()["values"]]
-        req = requests.get(kai + '/api/latest/config/soft_prompt')
-        current_softprompt = req.json()["value"]
-    except requests.exceptions.JSONDecodeError:
-        logger.error(f"Server {kai} is up but does not appear to be a KoboldAI server. Are you sure it's running the UNITED branch?")
-        return(False)
-    except requests.exceptions.ConnectionError:
-        logger.error(f"Server {kai} is not reachable. Are you sure it's running?")
-        return(False)
-    return(True)
-
-
-def bridge(interval, api_key, kai_name, kai_url, cluster, priority_usernames):
+# How long we trust the KAI config we last read, before asking for all of it again
+KAI_VALIDATION_TTL = 60
+# We keep our connections to the KAI instances and the horde alive between requests
+# All instances share the same pools, so adding more of them doesn't add more sockets to the horde
+kai_session = requests.Session()
+cluster_session = requests.Session()
+
+class KAIInstance:
+    def __init__(self, url, name):
+        self.url = url
+        self.name = name
+        self.model = ''
+        self.max_content_length = 1024
+        self.max_length = 80
+        self.current_softprompt = None
+        self.softprompts = {}
+        self.last_validation = 0
+        # Set while we're generating or submitting a job for this instance
+        self.busy = False
+        # If the instance couldn't be reached, we don't try it again before this time
+        self.retry_after = 0
+        # When jobs are popped ahead of time, how many are waiting or generating, and the softprompt the last one of them needs.
+        # That's the softprompt we'll have loaded by the time the next job we pop gets its turn
+        self.queued_jobs = 0
+        self.queued_softprompt = None
+        # The popping and generating threads both read and change our state
+        self.lock = threading.RLock()
+
+    # Forces the next validate() to re-read the whole KAI config
+    def invalidate(self):
+        with self.lock:
+            self.last_validation = 0
+
+    @logger.catch
+    def validate(self):
+        with self.lock:
+            return(self._validate())
+
+    def _validate(self):
+        kai = self.url
+        try:
+            req = kai_session.get(kai + '/api/latest/model')
+            current_model = req.json()["result"]
+            # The softprompt can be changed from the KAI UI at any time, so we always read it along with the model
+            req = kai_session.get(kai + '/api/latest/config/soft_prompt')
+            self.current_softprompt = req.json()["value"]
+            # As long as the model is the same, we can keep using the rest of the config we read before
+            if current_model == self.model and time.time() - self.last_validation < KAI_VALIDATION_TTL:
+                return(True)
+            self.last_validation = 0
+            self.model = current_model
+            req = kai_session.get(kai + '/api/latest/config/max_context_length')
+            self.max_content_length = req.json()["value"]
+            req = kai_session.get(kai + '/api/latest/config/max_length')
+            self.max_length = req.json()["value"]
+            if self.model not in self.softprompts:
+                    req = kai_session.get(kai + '/api/latest/config/soft_prompts_list')
+                    self.softprompts[self.model] = [sp['value'] for sp in req.json()["values"]]
+        except requests.exceptions.JSONDecodeError:
+            logger.error(f"Server {kai} is up but does not appear to be a KoboldAI server. Are you sure it's running the UNITED branch?")
+            self.invalidate()
+            return(False)
+        except requests.exceptions.ConnectionError:
+            logger.error(f"Server {kai} is not reachable. Are you sure it's running?")
+            self.invalidate()
+            return(False)
+        self.last_validation = time.time()
+        return(True)
+
+    def get_pop_dict(self, api_key, priority_usernames, pop_wait):
+        with self.lock:
+            current_softprompt = self.current_softprompt
+            if self.queued_jobs:
+                current_softprompt = self.queued_softprompt
+            return({
+                "api_key": api_key,
+                "name": self.name,
+                "model": self.model,
+                "max_length": self.max_length,
+                "max_content_length": self.max_content_length,
+                "priority_usernames": priority_usernames,
+                "softprompts": self.softprompts[self.model],
+                "current_softprompt": current_softprompt,
+                "wait": pop_wait,
+            })
+
+    # Called when a job is popped ahead of time, and once it's been generated
+    def queue_job(self, job):
+        with self.lock:
+            self.queued_jobs += 1
+            self.queued_softprompt = job['softprompt'] or ''
+
+    def finish_job(self):
+        with self.lock:
+            self.queued_jobs -= 1
+
+    def load_softprompt(self, softprompt):
+        with self.lock:
+            if softprompt == self.current_softprompt:
+                return
+            kai_session.put(self.url + '/api/latest/config/soft_prompt/', json = {"value": softprompt})
+            time.sleep(1) # Wait a second to unload the softprompt
+            self.current_softprompt = softprompt
+
+
+def bridge(interval, api_key, kai_name, kai_url, cluster, priority_usernames, pop_wait = 0):
+    kai = KAIInstance(kai_url, kai_name)
     current_id = None
     current_payload = None
     loop_retry = 0
     while True:
-        if not validate_kai(kai_url):
+        if not kai.validate():
             logger.warning(f"Waiting 10 seconds...")
             time.sleep(10)
             continue
-        gen_dict = {
-            "api_key": api_key,
-            "name": kai_name,
-            "model": model,
-            "max_length": max_length,
-            "max_content_length": max_content_length,
-            "priority_usernames": priority_usernames,
-            "softprompts": softprompts[model],
-        }
+        gen_dict = kai.get_pop_dict(api_key, priority_usernames, pop_wait)
         if current_id:
             loop_retry += 1
         else:
             try:
-                pop_req = requests.post(cluster + '/api/v1/generate/pop', json = gen_dict)
+                pop_start = time.time()
+                pop_req = cluster_session.post(cluster + '/api/v1/generate/pop', json = gen_dict, timeout = pop_wait + 30)
             except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout):
                 logger.error(f"Server {cluster} unavailable during pop. Waiting 10 seconds...")
                 time.sleep(10)
@@ -111,20 +179,21 @@ def bridge(interval, api_key, kai_name, kai_url, cluster, priority_usernames):
                 continue
             if not pop["id"]:
                 logger.debug(f"Server {cluster} has no valid generations to do for us. Skipped Info: {pop['skipped']}.")
-                time.sleep(interval)
+                # If the horde already held our request while waiting for new prompts, we can ask again immediately
+                if time.time() - pop_start < max(pop_wait, interval):
+                    time.sleep(interval)
                 continue
             current_id = pop['id']
             current_payload = pop['payload']
             # By default, we don't want to be annoucing the prompt send from the Horde to the terminal
             current_payload['quiet'] = True
             requested_softprompt = pop['softprompt']
-        if requested_softprompt != current_softprompt:
-            req = requests.put(kai_url + '/api/latest/config/soft_prompt/', json = {"value": requested_softprompt})
-            time.sleep(1) # Wait a second to unload the softprompt
+        kai.load_softprompt(requested_softprompt)
         try:
-            gen_req = requests.post(kai_url + '/api/latest/generate/', json = current_payload)
+            gen_req = kai_session.post(kai_url + '/api/latest/generate/', json = current_payload)
         except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout):
             logger.error(f"Worker {kai_url} unavailable. Waiting 10 seconds...")
+            kai.invalidate()
             time.sleep(10)
             continue
         if type(gen_req.json()) is not dict:
@@ -138,12 +207,14 @@ def bridge(interval, api_key, kai_name, kai_url, cluster, priority_usernames):
             req_json = gen_req.json()
         except json.decoder.JSONDecodeError:
             logger.error(f"Something went wrong when trying to generate on {kai_url}. Please check the health of the KAI worker. Retrying 10 seconds...")
+            kai.invalidate()
             time.sleep(interval)
             continue
         try:
             current_generation = req_json["results"][0]["text"]
         except KeyError: 
             logger.error(f"Unexpected response received from {kai_url}. Please check the health of the KAI worker. Retrying in 10 seconds...")
+            kai.invalidate()
             time.sleep(interval)
             continue
         submit_dict = {
@@ -153,7 +224,7 @@ def bridge(interval, api_key, kai_name, kai_url, cluster, priority_usernames):
         }
         while current_id and current_generation:
             try:
-                submit_req = requests.post(cluster + '/api/v1/generate/submit', json = submit_dict)
+                submit_req = cluster_session.post(cluster + '/api/v1/generate/submit', json = submit_dict)
                 if submit_req.status_code == 404:
                     logger.warning(f"The generation we were working on got stale. Aborting!")
                 elif not submit_req.ok:
@@ -176,6 +247,209 @@ def bridge(interval, api_key, kai_name, kai_url, cluster, priority_usernames):
         time.sleep(interval)
 
 
+# Pops a single job from the horde for the currently validated KAI config
+# Returns None if there's nothing to do, after waiting as appropriate.
+# If the KAI instance can't be validated, we don't wait for it, but set when it should be retried instead
+def pop_job(interval, api_key, kai, cluster, priority_usernames, pop_wait):
+    if not kai.validate():
+        logger.warning(f"Will retry instance {kai.name} in 10 seconds...")
+        kai.retry_after = time.time() + 10
+        return(None)
+    gen_dict = kai.get_pop_dict(api_key, priority_usernames, pop_wait)
+    try:
+        pop_start = time.time()
+        pop_req = cluster_session.post(cluster + '/api/v1/generate/pop', json = gen_dict, timeout = pop_wait + 30)
+    except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout):
+        logger.error(f"Server {cluster} unavailable during pop. Waiting 10 seconds...")
+        time.sleep(10)
+        return(None)
+    if not pop_req.ok:
+        logger.warning(f"During gen pop, server {cluster} responded: {pop_req.text}. Waiting for 10 seconds...")
+        time.sleep(10)
+        return(None)
+    try:
+        pop = pop_req.json()
+    except json.decoder.JSONDecodeError:
+        pop = None
+    if not pop:
+        logger.error(f"Something has gone wrong with {cluster}. Please inform its administrator!")
+        time.sleep(interval)
+        return(None)
+    if not pop["id"]:
+        logger.debug(f"Server {cluster} has no valid generations to do for us. Skipped Info: {pop['skipped']}.")
+        # If the horde already held our request while waiting for new prompts, we can ask again immediately
+        if time.time() - pop_start < max(pop_wait, interval):
+            time.sleep(interval)
+        return(None)
+    # By default, we don't want to be annoucing the prompt send from the Horde to the terminal
+    pop['payload']['quiet'] = True
+    return(pop)
+
+
+# Generates the job's payload on the KAI instance, retrying until we get a generation
+def generate_job(interval, kai, job):
+    kai_url = kai.url
+    kai.load_softprompt(job['softprompt'])
+    loop_retry = 0
+    while True:
+        try:
+            gen_req = kai_session.post(kai_url + '/api/latest/generate/', json = job['payload'])
+        except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout):
+            logger.error(f"Worker {kai_url} unavailable. Waiting 10 seconds...")
+            kai.invalidate()
+            time.sleep(10)
+            continue
+        if gen_req.status_code == 503:
+            loop_retry += 1
+            logger.debug(f'KAI instance {kai_url} Busy (attempt {loop_retry}). Will try again...')
+            continue
+        try:
+            req_json = gen_req.json()
+        except json.decoder.JSONDecodeError:
+            logger.error(f"Something went wrong when trying to generate on {kai_url}. Please check the health of the KAI worker. Retrying 10 seconds...")
+            kai.invalidate()
+            time.sleep(10)
+            continue
+        try:
+            return(req_json["results"][0]["text"])
+        except (KeyError, IndexError, TypeError):
+            logger.error(f"Unexpected response received from {kai_url}. Please check the health of the KAI worker. Retrying in 10 seconds...")
+            kai.invalidate()
+            time.sleep(10)
+            continue
+
+
+# Submits the generation to the horde, retrying until it's accepted or the horde tells us it's no longer needed
+def submit_job(cluster, api_key, job_id, generation):
+    submit_dict = {
+        "id": job_id,
+        "generation": generation,
+        "api_key": api_key,
+    }
+    while True:
+        try:
+            submit_req = cluster_session.post(cluster + '/api/v1/generate/submit', json = submit_dict)
+        except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout):
+            logger.warning(f"Server {cluster} unavailable during submit. Waiting 10 seconds...")
+            time.sleep(10)
+            continue
+        if submit_req.status_code == 404:
+            logger.warning(f"The generation we were working on got stale. Aborting!")
+        elif not submit_req.ok:
+            if "already submitted" in submit_req.text:
+                logger.warning(f'Server think this gen already submitted. Continuing')
+            else:
+                logger.error(submit_req.status_code)
+                logger.warning(f"During gen submit, server {cluster} responded: {submit_req.text}. Waiting for 10 seconds...")
+                time.sleep(10)
+                continue
+        else:
+            logger.info(f'Submitted generation with id {job_id} and contributed for {submit_req.json()["reward"]}')
+        return
+
+
+# Keeps up to pipeline_depth jobs popped ahead of the one currently generating
+def prefetch_jobs(job_slots, jobs, interval, api_key, kai, cluster, priority_usernames, pop_wait):
+    while True:
+        job_slots.acquire()
+        job = None
+        while not job:
+            time.sleep(max(kai.retry_after - time.time(), 0))
+            job = pop_job(interval, api_key, kai, cluster, priority_usernames, pop_wait)
+        kai.queue_job(job)
+        jobs.put(job)
+
+
+def submit_generations(generations, cluster, api_key):
+    while True:
+        job_id, generation = generations.get()
+        submit_job(cluster, api_key, job_id, generation)
+
+
+# Like bridge(), but pops and submits in their own threads, so that the KAI instance only ever waits for the next job
+# when the horde has nothing for it.
+def pipelined_bridge(interval, api_key, kai_name, kai_url, cluster, priority_usernames, pop_wait, pipeline_depth):
+    # One slot for the job we're generating, plus the ones we're allowed to have waiting
+    job_slots = threading.Semaphore(pipeline_depth + 1)
+    kai = KAIInstance(kai_url, kai_name)
+    jobs = queue.Queue()
+    generations = queue.Queue()
+    popper = threading.Thread(target=prefetch_jobs, args=(job_slots, jobs, interval, api_key, kai, cluster, priority_usernames, pop_wait))
+    popper.daemon = True
+    popper.start()
+    submitter = threading.Thread(target=submit_generations, args=(generations, cluster, api_key))
+    submitter.daemon = True
+    submitter.start()
+    while True:
+        job = jobs.get()
+        generation = generate_job(interval, kai, job)
+        kai.finish_job()
+        job_slots.release()
+        generations.put((job['id'], generation))
+
+
+def run_fleet_job(interval, kai, job, generations, instance_freed):
+    try:
+        generation = generate_job(interval, kai, job)
+        generations.put((job['id'], generation))
+    finally:
+        kai.busy = False
+        instance_freed.set()
+
+
+# Drives all the KAI instances in the fleet from a single pop loop.
+# Whenever an instance is idle, we ask the horde for a job for it, and hand the job to a generation thread.
+def fleet_bridge(interval, api_key, instances, cluster, priority_usernames, pop_wait):
+    # Every instance is its own host, and is used by its generator thread and by the pop loop's validation,
+    # so the shared session needs to keep a pool for each of them, or it keeps reconnecting to all of them
+    fleet_adapter = requests.adapters.HTTPAdapter(pool_connections = len(instances), pool_maxsize = 2)
+    kai_session.mount("http://", fleet_adapter)
+    kai_session.mount("https://", fleet_adapter)
+    generations = queue.Queue()
+    submitter = threading.Thread(target=submit_generations, args=(generations, cluster, api_key))
+    submitter.daemon = True
+    submitter.start()
+    instance_freed = threading.Event()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(instances)) as generators:
+        while True:
+            instance_freed.clear()
+            # Instances we couldn't reach are left alone until they're due to be retried, so that they don't hold up the rest
+            now = time.time()
+            idle_instances = [kai for kai in instances if not kai.busy and kai.retry_after <= now]
+            if not idle_instances:
+                retry_times = [kai.retry_after for kai in instances if not kai.busy]
+                if retry_times:
+                    instance_freed.wait(max(min(retry_times) - now, 0))
+                else:
+                    instance_freed.wait()
+                continue
+            # We can only let the horde hold our request when there's nobody else waiting on us to pop for them,
+            # which includes the instances which are still generating, as they might finish while we wait
+            wait = 0
+            if len(idle_instances) == 1 and not any(kai.busy for kai in instances):
+                wait = pop_wait
+            popped = False
+            for kai in idle_instances:
+                # Unless the horde is holding our request, we do our own waiting below, so that it's once per pass instead of once per instance
+                job = pop_job(interval if wait else 0, api_key, kai, cluster, priority_usernames, wait)
+                if not job:
+                    continue
+                kai.busy = True
+                popped = True
+                generators.submit(run_fleet_job, interval, kai, job, generations, instance_freed)
+            # If the horde didn't hold our request, we wait before asking again, unless an instance frees up first
+            if not popped and not wait:
+                instance_freed.wait(interval)
+
+
+# The fleet file is a json list of the KAI instances this bridge should drive, such as
+# [{"kai_name": "My Awesome Instance #1", "kai_url": "http://localhost:5000"}, {"kai_name": "My Awesome Instance #2", "kai_url": "http://localhost:5001"}]
+def load_fleet(fleet_file):
+    with open(fleet_file) as f:
+        fleet = json.load(f)
+    return([KAIInstance(instance["kai_url"], instance["kai_name"]) for instance in fleet])
+
+
 if __name__ == "__main__":
     args = arg_parser.parse_args()
     set_logger_verbosity(args.verbosity)
@@ -188,9 +462,21 @@ if __name__ == "__main__":
     kai_url = args.kai_url if args.kai_url else cd.kai_url
     cluster = args.cluster_url if args.cluster_url else cd.cluster_url
     priority_usernames = args.priority_usernames if args.priority_usernames else cd.priority_usernames
+    if args.fleet:
+        instances = load_fleet(args.fleet)
+        logger.init(f"Fleet of {len(instances)} Instances", status="Started")
+        try:
+            fleet_bridge(args.interval, api_key, instances, cluster, priority_usernames, args.pop_wait)
+        except KeyboardInterrupt:
+            logger.info(f"Keyboard Interrupt Received. Ending Process")
+        logger.init(f"Fleet of {len(instances)} Instances", status="Stopped")
+        exit()
     logger.init(f"{kai_name} Instance", status="Started")
     try:
-        bridge(args.interval, api_key, kai_name, kai_url, cluster, priority_usernames)
+        if args.pipeline_depth > 0:
+            pipelined_bridge(args.interval, api_key, kai_name, kai_url, cluster, priority_usernames, args.pop_wait, args.pipeline_depth)
+        else:
+            bridge(args.interval, api_key, kai_name, kai_url, cluster, priority_usernames, args.pop_wait)
     except KeyboardInterrupt:
         logger.info(f"Keyboard Interrupt Received. Ending Process")
     logger.init(f"{kai_name} Instance", status="Stopped")
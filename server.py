@@ -1,17 +1,18 @@
-from flask import Flask, render_template, redirect, url_for, request, abort
-from flask_restful import Resource, reqparse, Api
+from flask import Flask, render_template, redirect, url_for, request, abort, Response
+from flask_restful import Resource, reqparse, Api, inputs
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_dance.contrib.google import make_google_blueprint, google
 from flask_dance.contrib.discord import make_discord_blueprint, discord
 from flask_dance.contrib.github import make_github_blueprint, github
-import requests, random, time, os, oauthlib, secrets, argparse, logging
+import requests, random, time, os, oauthlib, secrets, argparse, logging, itertools, threading, json, hashlib, base64
 from enum import Enum
+from collections import OrderedDict
 from markdown import markdown
 from dotenv import load_dotenv
 from uuid import uuid4
 from werkzeug.middleware.proxy_fix import ProxyFix
-from server_classes import WaitingPrompt,ProcessingGeneration,KAIServer,PromptsIndex,GenerationsIndex,User,Database
+from server_classes import WaitingPrompt,ProcessingGeneration,KAIServer,PromptsIndex,GenerationsIndex,User,Database,GenerationCache,WebhookDispatcher
 from logger import logger, set_logger_verbosity, quiesce_logger
 
 class ServerErrors(Enum):
@@ -23,6 +24,8 @@ class ServerErrors(Enum):
     INVALID_API_KEY = 5
     INVALID_MODEL = 6
     NO_PROXY = 7
+    TOO_MANY_GENERATIONS = 8
+    INVALID_CALLBACK_URL = 9
 
 REST_API = Flask(__name__)
 # Very basic DOS prevention
@@ -33,6 +36,33 @@ limiter = Limiter(
 )
 api = Api(REST_API)
 dance_return_to = '/'
+# The maximum amount of seconds a server can wait for a prompt during pop
+MAX_POP_WAIT = 20
+# The most generations a single pop can hand out
+MAX_POP_JOBS = 20
+# How many kudos of priority a prompt can jump, if it lets the server keep its current softprompt loaded
+softprompt_tolerance = 50
+# How many matching prompts we look at while trying to avoid a softprompt swap
+MAX_SOFTPROMPT_LOOKAHEAD = 50
+# The most generations a single batch submit can contain
+MAX_SUBMIT_BATCH = 100
+# How many pop requests can be long-polling at the same time, so that they don't eat all our threads
+long_poll_slots = threading.BoundedSemaphore(20)
+# Likewise, every open status stream holds one of our worker threads
+stream_slots = threading.BoundedSemaphore(20)
+# How often a status stream checks for queue position changes
+STREAM_REFRESH_SECONDS = 1
+# How long a status stream can stay silent before we send a comment, so that dead connections are noticed
+STREAM_KEEPALIVE_SECONDS = 15
+# How many users or servers a listing page has, unless asked otherwise, and at most
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# How many users and servers the front page leaderboard shows
+LEADERBOARD_SIZE = 5
+# The front page markdown, read on first use. See get_index_template()
+index_template = None
+# For how many milliseconds we can keep serving the same listing or status response, while the data behind it doesn't change
+response_cache_ms = 1000
 load_dotenv()
 
 
@@ -61,6 +91,80 @@ def get_error(error, **kwargs):
     if error == ServerErrors.NO_PROXY:
         logger.warning(f'Attempt to access outside reverse proxy')
         return(f'Access allowed only through https')
+    if error == ServerErrors.TOO_MANY_GENERATIONS:
+        logger.warning(f'User "{kwargs["username"]}" tried to submit {kwargs["count"]} generations at once. Aborting!')
+        return(f'You cannot submit more than {MAX_SUBMIT_BATCH} generations at once.')
+    if error == ServerErrors.INVALID_CALLBACK_URL:
+        logger.warning(f'User "{kwargs["username"]}" sent an invalid callback url: {kwargs["callback_url"]}. Aborting!')
+        return(f'The callback url needs to be an http or https url, on a publicly reachable host.')
+
+class ResponseCache:
+    # Keeps the last response we built for each key, along with the version of the data it was built from.
+    # A response is reused while that version stays the same, but for no longer than response_cache_ms,
+    # as some of what we show also changes with time, such as which servers are stale.
+    def __init__(self, max_entries = 4096):
+        self.max_entries = max_entries
+        # key -> (version, expiry timestamp, body, etag)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version, build):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry[0] == version and time.time() < entry[1]:
+            return(entry[2], entry[3])
+        body = build()
+        etag = hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest()
+        with self.lock:
+            self.entries[key] = (version, time.time() + response_cache_ms / 1000, body, etag)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return(body, etag)
+
+response_cache = ResponseCache()
+
+# Returns the cached response for this key, or a 304 if the client already has it
+def get_cached_response(key, version, build):
+    body, etag = response_cache.get(key, version, build)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return(response)
+    return(body, 200, {"ETag": f'"{etag}"'})
+
+# Cursors are the sort key of the last item in the page, so that the next page continues right after it
+def encode_cursor(sort, key):
+    return(base64.urlsafe_b64encode(json.dumps([sort, list(key)]).encode()).decode())
+
+# Returns the sort key the cursor points to, or None if it's not a valid cursor for this sort.
+# Sort keys are (-sorted value, id), and id_type is the type of the listing's ids
+def decode_cursor(cursor, sort, id_type):
+    try:
+        cursor_sort, key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return(None)
+    if cursor_sort != sort or type(key) is not list or len(key) != 2:
+        return(None)
+    # Anything else would fail to compare against the keys in the sorted index
+    if type(key[0]) not in (int, float) or type(key[1]) is not id_type:
+        return(None)
+    return(tuple(key))
+
+# Parses the pagination arguments shared by the listings
+def get_page_parser(sort_choices):
+    parser = reqparse.RequestParser()
+    parser.add_argument("sort", type=str, required=False, default=sort_choices[0], choices=sort_choices, location="args", help="What to sort the listing by, descending")
+    parser.add_argument("limit", type=int, required=False, default=DEFAULT_PAGE_SIZE, location="args", help="How many entries to return in this page")
+    parser.add_argument("cursor", type=str, required=False, default=None, location="args", help="The next_cursor of the previous page")
+    parser.add_argument("fields", type=str, required=False, default=None, location="args", help="A comma-separated list of the fields to return for each entry")
+    return(parser)
+
+def project_fields(entry, fields):
+    if not fields:
+        return(entry)
+    field_list = fields.split(',')
+    return({field: value for field, value in entry.items() if field in field_list})
 
 @REST_API.before_request
 def limit_remote_addr():
@@ -85,6 +189,7 @@ class SyncGenerate(Resource):
         parser.add_argument("params", type=dict, required=False, default={}, help="Extra generate params to send to the KoboldAI server")
         parser.add_argument("servers", type=str, action='append', required=False, default=[], help="If specified, only the server with this ID will be able to generate this prompt")
         parser.add_argument("softprompts", type=str, action='append', required=False, default=[''], help="If specified, only servers who can load this softprompt will generate this request")
+        parser.add_argument("cacheable", type=inputs.boolean, required=False, default=False, help="If true, an identical earlier request's generations can be returned instead of generating new ones")
         # Not implemented yet
         parser.add_argument("world_info", type=str, required=False, help="If specified, only servers who can load this this world info will generate this request")
         args = parser.parse_args()
@@ -100,6 +205,13 @@ class SyncGenerate(Resource):
         wp_count = _waiting_prompts.count_waiting_requests(user)
         if wp_count > user.max_concurrent_wps:
             return(f"{get_error(ServerErrors.TOO_MANY_PROMPTS, username = username, wp_count = wp_count)}",503)
+        cache = None
+        cache_key = None
+        cached_generations = None
+        if args.cacheable:
+            cache = _generation_cache
+            cache_key = GenerationCache.get_key(args["prompt"], args["params"], args["models"], args["softprompts"])
+            cached_generations = cache.get(cache_key)
         wp = WaitingPrompt(
             _db,
             _waiting_prompts,
@@ -110,10 +222,16 @@ class SyncGenerate(Resource):
             args["params"],
             servers=args["servers"],
             softprompts=args["softprompts"],
-
+            cache=cache,
+            cache_key=cache_key,
         )
+        if cached_generations:
+            wp.activate_from_cache(cached_generations)
+            if not api_version:
+                return([gen['text'] for gen in cached_generations], 200)
+            return(cached_generations, 200)
         server_found = False
-        for server in _db.servers.values():
+        for server in _db.get_active_servers():
             if len(args.servers) and server.id not in args.servers:
                 continue
             if server.can_generate(wp)[0]:
@@ -124,12 +242,9 @@ class SyncGenerate(Resource):
             return("No active server found to fulfill this request. Please Try again later...", 503)
         # if a server is available to fulfil this prompt, we activate it and add it to the queue to be generated
         wp.activate()
-        while True:
-            time.sleep(1)
-            if wp.is_stale():
-                return("Prompt Request Expired", 500)
-            if wp.is_completed():
-                break
+        # We're woken up as soon as the last generation is submitted, or when the request expires
+        if not wp.wait_for_completion():
+            return("Prompt Request Expired", 500)
         if not api_version:
             return([gen['text'] for gen in wp.get_status()['generations']], 200)
         else:
@@ -143,7 +258,7 @@ class AsyncGeneratePrompt(Resource):
         wp = _waiting_prompts.get_item(id)
         if not wp:
             return("ID not found", 404)
-        return(wp.get_status(), 200)
+        return(get_cached_response(("prompt", wp.id), get_wp_status_version(wp), wp.get_status))
 
 
 class AsyncCheck(Resource):
@@ -152,7 +267,64 @@ class AsyncCheck(Resource):
         wp = _waiting_prompts.get_item(id)
         if not wp:
             return("ID not found", 404)
-        return(wp.get_lite_status(), 200)
+        return(get_cached_response(("check", wp.id), get_wp_status_version(wp), wp.get_lite_status))
+
+
+# A WP's status changes with its own generations, but also with its place in the queue and the horde's speed
+def get_wp_status_version(wp):
+    return((wp.status_version, _waiting_prompts.get_version(), _db.stats_version))
+
+
+class AsyncStream(Resource):
+    @logger.catch
+    def get(self, api_version = None, id = ''):
+        wp = _waiting_prompts.get_item(id)
+        if not wp:
+            return("ID not found", 404)
+        if not stream_slots.acquire(blocking=False):
+            return("Too many status streams open. Please try again later...", 503)
+        response = Response(self.stream_status(wp), mimetype='text/event-stream')
+        response.headers["Cache-Control"] = "no-cache"
+        response.call_on_close(stream_slots.release)
+        return(response)
+
+    # Sends a server-sent event whenever the WP's queue position changes, a generation starts or finishes, and once it's done
+    def stream_status(self, wp):
+        queue_position = None
+        started_ids = set()
+        finished_ids = set()
+        sent_cached = 0
+        last_sent = time.time()
+        while True:
+            # We take note of the version before looking, so that we don't miss changes which happen while we do
+            status_version = wp.status_version
+            events = []
+            current_position = wp.get_own_queue_stats()[0] + 1
+            if current_position != queue_position:
+                queue_position = current_position
+                events.append(("queue", {"queue_position": queue_position}))
+            for gen_dict in wp.cached_generations[sent_cached:]:
+                events.append(("generation", gen_dict))
+                sent_cached += 1
+            for procgen in wp.get_snapshot()[1]:
+                if procgen.id not in started_ids:
+                    started_ids.add(procgen.id)
+                    events.append(("generation_started", {"server_id": procgen.server.id, "server_name": procgen.server.name}))
+                if procgen.id not in finished_ids and procgen.is_completed():
+                    finished_ids.add(procgen.id)
+                    events.append(("generation", {"text": procgen.generation, "server_id": procgen.server.id, "server_name": procgen.server.name}))
+            finished = wp.finished.is_set()
+            if finished:
+                events.append(("done", {"done": wp.is_completed()}))
+            for event, data in events:
+                yield(f"event: {event}\ndata: {json.dumps(data)}\n\n")
+                last_sent = time.time()
+            if finished:
+                return
+            if time.time() - last_sent > STREAM_KEEPALIVE_SECONDS:
+                yield(": keep-alive\n\n")
+                last_sent = time.time()
+            wp.wait_for_status_change(status_version, STREAM_REFRESH_SECONDS)
 
 
 class AsyncGenerate(Resource):
@@ -165,6 +337,8 @@ class AsyncGenerate(Resource):
         parser.add_argument("params", type=dict, required=False, default={}, help="Extra generate params to send to the KoboldAI server")
         parser.add_argument("servers", type=str, action='append', required=False, default=[], help="If specified, only the server with this ID will be able to generate this prompt")
         parser.add_argument("softprompts", action='append', required=False, default=[''], help="If specified, only servers who can load this softprompt will generate this request")
+        parser.add_argument("cacheable", type=inputs.boolean, required=False, default=False, help="If true, an identical earlier request's generations can be returned instead of generating new ones")
+        parser.add_argument("callback_url", type=str, required=False, default=None, help="If specified, the generations will be POSTed to this url once they're all done")
         args = parser.parse_args()
         user = _db.find_user_by_api_key(args['api_key'])
         if not user:
@@ -174,6 +348,15 @@ class AsyncGenerate(Resource):
             return(f"{get_error(ServerErrors.EMPTY_PROMPT, username = user.get_unique_alias())}",400)
         if wp_count > user.max_concurrent_wps:
             return(f"{get_error(ServerErrors.TOO_MANY_PROMPTS, username = user.get_unique_alias(), wp_count = wp_count)}",503)
+        if args.callback_url and not _webhook_dispatcher.is_allowed_url(args.callback_url):
+            return(f"{get_error(ServerErrors.INVALID_CALLBACK_URL, username = user.get_unique_alias(), callback_url = args.callback_url)}",400)
+        cache = None
+        cache_key = None
+        cached_generations = None
+        if args.cacheable:
+            cache = _generation_cache
+            cache_key = GenerationCache.get_key(args["prompt"], args["params"], args["models"], args["softprompts"])
+            cached_generations = cache.get(cache_key)
         wp = WaitingPrompt(
             _db,
             _waiting_prompts,
@@ -184,9 +367,15 @@ class AsyncGenerate(Resource):
             args["params"],
             servers=args["servers"],
             softprompts=args["softprompts"],
-
+            cache=cache,
+            cache_key=cache_key,
+            webhooks=_webhook_dispatcher,
+            callback_url=args.callback_url,
         )
-        wp.activate()
+        if cached_generations:
+            wp.activate_from_cache(cached_generations)
+        else:
+            wp.activate()
         return({"id":wp.id}, 200)
 
 
@@ -201,8 +390,10 @@ class PromptPop(Resource):
         parser.add_argument("max_content_length", type=int, required=False, default=2048, help="The max amount of context to submit to this AI for sampling.")
         parser.add_argument("priority_usernames", type=str, action='append', required=False, default=[], help="The usernames which get priority use on this server")
         parser.add_argument("softprompts", type=str, action='append', required=False, default=[], help="The available softprompt files on this cluster for the currently running model")
+        parser.add_argument("wait", type=int, required=False, default=0, help="If set, and there's nothing to generate, wait up to this many seconds for a matching prompt to arrive before returning")
+        parser.add_argument("current_softprompt", type=str, required=False, default=None, help="The softprompt currently loaded on this KoboldAI, so that we can avoid giving it prompts which need it swapped")
+        parser.add_argument("max_jobs", type=int, required=False, default=None, help="If set, return a list of up to this many generations to do, instead of a single one")
         args = parser.parse_args()
-        skipped = {}
         user = _db.find_user_by_api_key(args['api_key'])
         if not user:
             return(f"{get_error(ServerErrors.INVALID_API_KEY, subject = 'server promptpop: ' + args['name'])}",401)
@@ -214,45 +405,157 @@ class PromptPop(Resource):
             server.create(user, args['name'], args["softprompts"])
         if user != server.user:
             return(f"{get_error(ServerErrors.WRONG_CREDENTIALS,kai_instance = args['name'], username = user.get_unique_alias())}",401)
-        server.check_in(args['model'], args['max_length'], args['max_content_length'], args["softprompts"])
+        server.check_in(args['model'], args['max_length'], args['max_content_length'], args["softprompts"], args["current_softprompt"])
         # This ensures that the priority requested by the bridge is respected
-        prioritized_wp = []
         priority_users = [user]
-        ## Start prioritize by bridge request ##
         for priority_username in args.priority_usernames:
             priority_user = _db.find_user_by_username(priority_username)
             if priority_user:
                 priority_users.append(priority_user)
-        for priority_user in priority_users:
-            for wp in _waiting_prompts.get_all():
-                if wp.user == priority_user and wp.needs_gen():
-                    prioritized_wp.append(wp)
-        ## End prioritize by bridge request ##
-        for wp in _waiting_prompts.get_waiting_wp_by_kudos():
-            if wp not in prioritized_wp:
-                prioritized_wp.append(wp)
-        for wp in prioritized_wp:
-            check_gen = server.can_generate(wp)
-            if not check_gen[0]:
-                skipped_reason = check_gen[1]
-                skipped[skipped_reason] = skipped.get(skipped_reason,0) + 1
-                continue
-            matching_softprompt = False
-            for sp in wp.softprompts:
-                # If a None softprompts has been provided, we always match, since we can always remove the softprompt
-                if sp == '':
-                    matching_softprompt = sp
-                for sp_name in args['softprompts']:
-                    # logger.info([sp_name,sp,sp in sp_name])
-                    if sp in sp_name: # We do a very basic string matching. Don't think we need to do regex
-                        matching_softprompt = sp_name
-                        break
-                if matching_softprompt:
+        # Long-polling servers hold one of our worker threads while waiting
+        # So we only allow a limited amount of them at the same time, and the rest just return immediately
+        wait_time = min(max(args.wait, 0), MAX_POP_WAIT)
+        max_jobs = 1
+        if args.max_jobs is not None:
+            max_jobs = min(max(args.max_jobs, 1), MAX_POP_JOBS)
+        long_polling = wait_time > 0 and long_poll_slots.acquire(blocking=False)
+        deadline = time.time() + wait_time
+        try:
+            while True:
+                # We take note of the new prompts seen before we search, so that we don't miss any which arrive while we do
+                arrivals = _waiting_prompts.count_arrivals()
+                jobs, skipped = self.pop_matching_wps(server, priority_users, args['softprompts'], max_jobs)
+                if jobs:
+                    if args.max_jobs is not None:
+                        return({"jobs": jobs, "skipped": skipped}, 200)
+                    return(jobs[0], 200)
+                remaining_time = deadline - time.time()
+                if not long_polling or remaining_time <= 0:
                     break
-            ret = wp.start_generation(server, matching_softprompt)
-            return(ret, 200)
+                _waiting_prompts.wait_for_arrivals(arrivals, remaining_time)
+        finally:
+            if long_polling:
+                long_poll_slots.release()
+        if args.max_jobs is not None:
+            return({"jobs": [], "skipped": skipped}, 200)
         return({"id": None, "skipped": skipped}, 200)
 
+    # Finds up to max_jobs generations this server can do, in priority order, and starts them.
+    # A WP which needs more than one generation can provide more than one job.
+    def pop_matching_wps(self, server, priority_users, softprompts, max_jobs = 1):
+        while True:
+            matches, skipped = self.find_matching_wps(server, priority_users, softprompts, max_jobs)
+            jobs = []
+            swaps = 0
+            loaded_softprompt = server.current_softprompt
+            for wp, matching_softprompt, jobs_from_wp in matches:
+                started_jobs = 0
+                for _ in range(jobs_from_wp):
+                    job = wp.start_generation(server, matching_softprompt)
+                    if job is None:
+                        break
+                    jobs.append(job)
+                    started_jobs += 1
+                if not started_jobs:
+                    continue
+                if loaded_softprompt is not None and (matching_softprompt or '') != loaded_softprompt:
+                    swaps += 1
+                loaded_softprompt = matching_softprompt or ''
+            if swaps:
+                _db.stats.record_softprompt_swaps(swaps)
+            # If other servers claimed everything we matched before we could, the queue might still have
+            # something else for us, so we look again instead of sending the server away empty-handed
+            if jobs or not matches:
+                return(jobs, skipped)
+
+    # Walks the queue for up to max_jobs generations this server can do, in priority order, without starting them.
+    # Returns them as (wp, matching softprompt, jobs from this wp) along with the reasons we skipped the rest
+    def find_matching_wps(self, server, priority_users, softprompts, max_jobs):
+        skipped = {}
+        matches = []
+        matched_jobs = 0
+        # Walking the queue needs its lock, so that nothing moves under us while we do.
+        # Other servers can still claim the WPs we matched before we start them, which start_generation() tells us
+        with _waiting_prompts.lock:
+            prioritized_wp = []
+            ## Start prioritize by bridge request ##
+            for priority_user in priority_users:
+                for wp in _waiting_prompts.get_user_wps(priority_user):
+                    if wp.needs_gen():
+                        prioritized_wp.append(wp)
+            ## End prioritize by bridge request ##
+            prioritized_ids = set([wp.id for wp in prioritized_wp])
+            # We only walk the WPs which this server's model and lengths can fulfil, lazily,
+            # so we stop paying as soon as we find something we can generate
+            remaining_wp = (wp for wp in _waiting_prompts.iter_candidate_wps(server) if wp.id not in prioritized_ids)
+            # If the server told us which softprompt it has loaded, the prompts which can use it are picked first,
+            # as long as their priority is within softprompt_tolerance kudos of the best prompt we could give it.
+            # The ones needing a swap are deferred until we leave that window.
+            use_affinity = server.current_softprompt is not None and softprompt_tolerance > 0
+            affinity_window = None
+            deferred = []
+            for wp in itertools.chain(prioritized_wp, remaining_wp):
+                check_gen = server.can_generate(wp)
+                if not check_gen[0]:
+                    skipped_reason = check_gen[1]
+                    skipped[skipped_reason] = skipped.get(skipped_reason,0) + 1
+                    continue
+                matching_softprompt = self.get_matching_softprompt(wp, softprompts)
+                if use_affinity:
+                    if affinity_window is None:
+                        affinity_window = {
+                            "prioritized": wp.id in prioritized_ids,
+                            "min_kudos": wp.user.kudos - softprompt_tolerance,
+                            "lookahead": MAX_SOFTPROMPT_LOOKAHEAD,
+                        }
+                    affinity_window["lookahead"] -= 1
+                    if affinity_window["lookahead"] < 0 \
+                            or affinity_window["prioritized"] != (wp.id in prioritized_ids) \
+                            or wp.user.kudos < affinity_window["min_kudos"]:
+                        use_affinity = False
+                        for deferred_wp, deferred_softprompt in deferred:
+                            matched_jobs += self.add_match(matches, deferred_wp, deferred_softprompt, max_jobs - matched_jobs)
+                            if matched_jobs >= max_jobs:
+                                break
+                        if matched_jobs >= max_jobs:
+                            break
+                    elif (matching_softprompt or '') != server.current_softprompt:
+                        deferred.append((wp, matching_softprompt))
+                        continue
+                matched_jobs += self.add_match(matches, wp, matching_softprompt, max_jobs - matched_jobs)
+                if matched_jobs >= max_jobs:
+                    break
+            else:
+                for deferred_wp, deferred_softprompt in deferred:
+                    if matched_jobs >= max_jobs:
+                        break
+                    matched_jobs += self.add_match(matches, deferred_wp, deferred_softprompt, max_jobs - matched_jobs)
+                # The WPs which could never match this server were not looked at, so we count them in bulk
+                _waiting_prompts.count_skipped_wps(server, skipped, prioritized_ids)
+        # The generations are only started once we're done walking the queue, as starting them changes its order
+        return(matches, skipped)
+
+    def get_matching_softprompt(self, wp, softprompts):
+        matching_softprompt = False
+        for sp in wp.softprompts:
+            # If a None softprompts has been provided, we always match, since we can always remove the softprompt
+            if sp == '':
+                matching_softprompt = sp
+            for sp_name in softprompts:
+                # logger.info([sp_name,sp,sp in sp_name])
+                if sp in sp_name: # We do a very basic string matching. Don't think we need to do regex
+                    matching_softprompt = sp_name
+                    break
+            if matching_softprompt:
+                break
+        return(matching_softprompt)
+
+    # Adds as many of the generations this WP still needs as we have room for. Returns how many we added.
+    def add_match(self, matches, wp, matching_softprompt, room):
+        jobs_from_wp = min(wp.n, room)
+        matches.append((wp, matching_softprompt, jobs_from_wp))
+        return(jobs_from_wp)
+
 
 class SubmitGeneration(Resource):
     def post(self, api_version = None):
@@ -274,6 +577,38 @@ class SubmitGeneration(Resource):
             return(f"{get_error(ServerErrors.DUPLICATE_GEN,id = args['id'])}",400)
         return({"reward": tokens}, 200)
 
+class BatchSubmitGeneration(Resource):
+    def post(self, api_version = None):
+        parser = reqparse.RequestParser()
+        parser.add_argument("api_key", type=str, required=True, help="The server's owner API key")
+        parser.add_argument("generations", type=dict, action='append', required=True, help="A list of the finished generations, each as an object with their processing generation 'id' and 'generation' text")
+        args = parser.parse_args()
+        user = _db.find_user_by_api_key(args['api_key'])
+        if not user:
+            return(f"{get_error(ServerErrors.INVALID_API_KEY, subject = 'server batch submit')}",401)
+        if len(args['generations']) > MAX_SUBMIT_BATCH:
+            return(f"{get_error(ServerErrors.TOO_MANY_GENERATIONS, username = user.get_unique_alias(), count = len(args['generations']))}",400)
+        # Each generation is claimed on its own, so one bad id doesn't throw away the rest of the batch
+        results = []
+        claimed = []
+        for submitted in args['generations']:
+            procgen_id = submitted.get('id')
+            procgen = _processing_generations.get_item(procgen_id)
+            if not procgen:
+                results.append({"id": procgen_id, "error": get_error(ServerErrors.INVALID_PROCGEN,id = procgen_id)})
+                continue
+            if user != procgen.server.user:
+                results.append({"id": procgen_id, "error": get_error(ServerErrors.WRONG_CREDENTIALS,kai_instance = procgen.server.name, username = user.get_unique_alias())})
+                continue
+            if not procgen.claim_generation(str(submitted.get('generation', ''))):
+                results.append({"id": procgen_id, "error": get_error(ServerErrors.DUPLICATE_GEN,id = procgen_id)})
+                continue
+            claimed.append(procgen)
+            results.append({"id": procgen_id, "reward": procgen.kudos})
+        # But their kudos are handed out together
+        _db.reward_generations(claimed)
+        return({"results": results}, 200)
+
 class TransferKudos(Resource):
     def post(self, api_version = None):
         parser = reqparse.RequestParser()
@@ -294,40 +629,68 @@ class TransferKudos(Resource):
 class Models(Resource):
     @logger.catch
     def get(self, api_version = None):
-        return(_db.get_available_models(),200)
+        return(get_cached_response("models", _db.servers_version, _db.get_available_models))
 
 
 class Servers(Resource):
-    @logger.catch
+    # Not wrapped in logger.catch, as that would also swallow the errors parse_args() aborts with
     def get(self, api_version = None):
+        # Without any arguments, we keep returning every active server in one list
+        if not request.args:
+            return(get_cached_response("servers", _db.servers_version, self.get_servers))
+        parser = get_page_parser(("kudos", "contributions"))
+        parser.add_argument("active", type=inputs.boolean, required=False, default=True, location="args", help="If false, servers which haven't checked in recently are included as well")
+        parser.add_argument("model", type=str, required=False, default=None, location="args", help="If specified, only servers running this model are included")
+        args = parser.parse_args()
+        after_key = None
+        if args.cursor:
+            after_key = decode_cursor(args.cursor, args.sort, str)
+            if after_key is None:
+                return("Invalid cursor", 400)
+        return(get_cached_response(("servers", request.query_string), _db.servers_version, lambda: self.get_servers_page(args, after_key)))
+
+    def get_servers(self):
         servers_ret = []
-        for server in _db.servers.values():
-            if server.is_stale():
-                continue
-            sdict = {
-                "name": server.name,
-                "id": server.id,
-                "model": server.model,
-                "max_length": server.max_length,
-                "max_content_length": server.max_content_length,
-                "tokens_generated": server.contributions,
-                "requests_fulfilled": server.fulfilments,
-                "kudos_rewards": server.kudos,
-                "kudos_details": server.kudos_details,
-                "performance": server.get_performance(),
-                "uptime": server.uptime,
-            }
-            servers_ret.append(sdict)
-        return(servers_ret,200)
+        for server in _db.get_active_servers():
+            servers_ret.append(self.get_server_dict(server))
+        return(servers_ret)
+
+    def get_servers_page(self, args, after_key):
+        # Active servers have their own sorted indexes, so that we only page through the ones we return
+        sorted_index = _db.get_server_sort_index(args.sort, args.active, args.model)
+        accept = None
+        if args.model and not args.active:
+            accept = lambda server: server.model == args.model
+        limit = min(max(args.limit, 1), MAX_PAGE_SIZE)
+        servers, last_key = _db.get_sorted_page(sorted_index, after_key, limit, accept)
+        ret_dict = {
+            "servers": [project_fields(self.get_server_dict(server), args.fields) for server in servers],
+            "next_cursor": None,
+        }
+        if last_key is not None:
+            ret_dict["next_cursor"] = encode_cursor(args.sort, last_key)
+        return(ret_dict)
+
+    def get_server_dict(self, server):
+        sdict = {
+            "name": server.name,
+            "id": server.id,
+            "model": server.model,
+            "max_length": server.max_length,
+            "max_content_length": server.max_content_length,
+            "tokens_generated": server.contributions,
+            "requests_fulfilled": server.fulfilments,
+            "kudos_rewards": server.kudos,
+            "kudos_details": server.kudos_details,
+            "performance": server.get_performance(),
+            "uptime": server.uptime,
+        }
+        return(sdict)
 
 class ServerSingle(Resource):
     @logger.catch
     def get(self, api_version = None, server_id = ''):
-        server = None
-        for s in _db.servers.values():
-            if s.id == server_id:
-                server = s
-                break
+        server = _db.find_server_by_id(server_id)
         if server:
             sdict = {
                 "name": server.name,
@@ -346,18 +709,52 @@ class ServerSingle(Resource):
 
 
 class Users(Resource):
-    @logger.catch
+    # Not wrapped in logger.catch, as that would also swallow the errors parse_args() aborts with
     def get(self, api_version = None):
+        # Without any arguments, we keep returning every user in one dict
+        if not request.args:
+            return(get_cached_response("users", _db.users_version, self.get_users))
+        parser = get_page_parser(("kudos", "contributions"))
+        args = parser.parse_args()
+        after_key = None
+        if args.cursor:
+            after_key = decode_cursor(args.cursor, args.sort, int)
+            if after_key is None:
+                return("Invalid cursor", 400)
+        return(get_cached_response(("users", request.query_string), _db.users_version, lambda: self.get_users_page(args, after_key)))
+
+    def get_users(self):
         user_dict = {}
         for user in _db.users.values():
-            user_dict[user.get_unique_alias()] = {
-                "id": user.id,
-                "kudos": user.kudos,
-                "kudos_details": user.kudos_details,
-                "usage": user.usage,
-                "contributions": user.contributions,
-            }
-        return(user_dict,200)
+            udict = self.get_user_dict(user)
+            del udict["username"]
+            user_dict[user.get_unique_alias()] = udict
+        return(user_dict)
+
+    def get_users_page(self, args, after_key):
+        sorted_index = _db.users_by_kudos
+        if args.sort == "contributions":
+            sorted_index = _db.users_by_contributions
+        limit = min(max(args.limit, 1), MAX_PAGE_SIZE)
+        users, last_key = _db.get_sorted_page(sorted_index, after_key, limit)
+        ret_dict = {
+            "users": [project_fields(self.get_user_dict(user), args.fields) for user in users],
+            "next_cursor": None,
+        }
+        if last_key is not None:
+            ret_dict["next_cursor"] = encode_cursor(args.sort, last_key)
+        return(ret_dict)
+
+    def get_user_dict(self, user):
+        udict = {
+            "username": user.get_unique_alias(),
+            "id": user.id,
+            "kudos": user.kudos,
+            "kudos_details": user.kudos_details,
+            "usage": user.usage,
+            "contributions": user.contributions,
+        }
+        return(udict)
 
 
 class UserSingle(Resource):
@@ -365,10 +762,8 @@ class UserSingle(Resource):
     def get(self, api_version = None, user_id = ''):
         logger.debug(user_id)
         user = None
-        for u in _db.users.values():
-            if str(u.id) == user_id:
-                user = u
-                break
+        if user_id.isdigit():
+            user = _db.find_user_by_id(int(user_id))
         if user:
             udict = {
                 "username": user.get_unique_alias(),
@@ -383,18 +778,40 @@ class UserSingle(Resource):
 class HordeLoad(Resource):
     @logger.catch
     def get(self, api_version = None):
+        return(get_cached_response("load", (_waiting_prompts.get_version(), _db.stats_version), self.get_load))
+
+    def get_load(self):
         load_dict = _waiting_prompts.count_totals()
         load_dict["kilotokens_per_min"] = _db.stats.get_kilotokens_per_min()
+        load_dict["kilotokens_per_min_by_window"] = _db.stats.get_kilotokens_per_min_by_window()
+        load_dict["softprompt_swaps_per_hour"] = _db.stats.get_softprompt_swaps_per_hour()
+        load_dict["generation_cache"] = _generation_cache.get_stats()
+        load_dict["pending_webhooks"] = _webhook_dispatcher.count_pending()
         logger.debug(load_dict)
-        return(load_dict,200)
+        return(load_dict)
 
 @logger.catch
 @REST_API.route('/')
 def index():
-    with open('index.md') as index_file:
-        index = index_file.read()
-    top_contributor = _db.get_top_contributor()
-    top_server = _db.get_top_server()
+    index_version = (_db.users_version, _db.servers_version, _db.stats_version, _waiting_prompts.get_version())
+    return(get_cached_response("index", index_version, render_index))
+
+def get_index_template():
+    global index_template
+    if index_template is None:
+        with open('index.md') as index_file:
+            index_template = index_file.read()
+    return(index_template)
+
+def render_index():
+    index = get_index_template()
+    top_contributors_list = _db.get_top_contributors(LEADERBOARD_SIZE)
+    top_servers_list = _db.get_top_servers(LEADERBOARD_SIZE)
+    top_contributor = None
+    top_server = None
+    if top_contributors_list and top_servers_list:
+        top_contributor = top_contributors_list[0]
+        top_server = top_servers_list[0]
     align_image = 0
     big_image = align_image
     while big_image == align_image:
@@ -415,7 +832,7 @@ This is the server which has generated the most tokens for the horde.
 * {top_server.contributions} tokens generated.
 * {top_server.fulfilments} request fulfillments.
 * {top_server.get_human_readable_uptime()} uptime.
-
+{get_runners_up_markdown([(user.get_unique_alias(), user.contributions['tokens']) for user in top_contributors_list[1:]], [(server.name, server.contributions) for server in top_servers_list[1:]])}
 <img src="https://github.com/db0/KoboldAI-Horde/blob/master/img/{big_image}.jpg?raw=true" width="800" />
 """
     policies = """
@@ -440,6 +857,20 @@ This is the server which has generated the most tokens for the horde.
     """
     return(head + markdown(findex + top_contributors + policies))
 
+def get_runners_up_markdown(users, servers):
+    if not users and not servers:
+        return('')
+    runners_up = "\n### Runners Up\n"
+    if users:
+        runners_up += "#### Users\n"
+        for position, (name, tokens) in enumerate(users, start = 2):
+            runners_up += f"* #{position} {name}: {tokens} tokens\n"
+    if servers:
+        runners_up += "#### Servers\n"
+        for position, (name, tokens) in enumerate(servers, start = 2):
+            runners_up += f"* #{position} {name}: {tokens} tokens\n"
+    return(runners_up)
+
 def get_oauth_id():
     google_data = None
     discord_data = None
@@ -492,8 +923,7 @@ def register():
         api_key = secrets.token_urlsafe(16)
         if user:
             username = request.form['username']
-            user.username = request.form['username']
-            user.api_key = api_key
+            user.set_credentials(request.form['username'], api_key)
         else:
             # Triggered when the user created a username without logging in
             if not oauth_id:
@@ -596,21 +1026,33 @@ arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument('-i', '--insecure', action="store_true", help="If set, will use http instead of https (useful for testing)")
 arg_parser.add_argument('-v', '--verbosity', action='count', default=0, help="The default logging level is ERROR or higher. This value increases the amount of logging seen in your screen")
 arg_parser.add_argument('-q', '--quiet', action='count', default=0, help="The default logging level is ERROR or higher. This value decreases the amount of logging seen in your screen")
-arg_parser.add_argument('-c', '--convert_flag', action='store', default=None, required=False, type=str, help="A special flag to convert from previous DB entries to newer and exit")
+arg_parser.add_argument('-c', '--convert_flag', action='store', default=None, required=False, type=str, help="A special flag to convert from previous DB entries to newer and exit. Use 'to_sqlite' to import the JSON files into the SQLite DB")
+arg_parser.add_argument('--softprompt_tolerance', action='store', default=softprompt_tolerance, required=False, type=int, help="How many kudos of priority a prompt can jump ahead of others, if it lets the server avoid swapping its softprompt. 0 disables it")
+arg_parser.add_argument('--generation_cache_mb', action='store', default=64, required=False, type=int, help="How many megabytes of generated text to keep around for answering identical cacheable requests")
+arg_parser.add_argument('--generation_cache_ttl', action='store', default=3600, required=False, type=int, help="How many seconds a cached generation can be reused for")
+arg_parser.add_argument('--response_cache_ms', action='store', default=response_cache_ms, required=False, type=int, help="For how many milliseconds the listing and status responses can be served from cache")
+arg_parser.add_argument('--db_backend', action='store', default='json', required=False, choices=['json', 'sqlite'], help="Where to store the horde's users, servers and stats")
 
 if __name__ == "__main__":
     global _db
     global _waiting_prompts
     global _processing_generations
+    global _generation_cache
+    global _webhook_dispatcher
 
     args = arg_parser.parse_args()
     set_logger_verbosity(args.verbosity)
     quiesce_logger(args.quiet)    
+    softprompt_tolerance = args.softprompt_tolerance
+    response_cache_ms = args.response_cache_ms
     # Only setting this for the WSGI logs
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s',level=logging.ERROR)
-    _db = Database(convert_flag=args.convert_flag)
+    _db = Database(convert_flag=args.convert_flag, storage_type=args.db_backend)
     _waiting_prompts = PromptsIndex()
     _processing_generations = GenerationsIndex()
+    _generation_cache = GenerationCache(max_bytes=args.generation_cache_mb * 1024 * 1024, ttl=args.generation_cache_ttl)
+    _webhook_dispatcher = WebhookDispatcher()
+    _db.register_kudos_change_callback(_waiting_prompts.update_user_priority)
     google_client_id = os.getenv("GOOGLE_CLIENT_ID")
     google_client_secret = os.getenv("GLOOGLE_CLIENT_SECRET")
     discord_client_id = os.getenv("DISCORD_CLIENT_ID")
@@ -648,9 +1090,11 @@ if __name__ == "__main__":
     api.add_resource(SyncGenerate, "/generate/sync","/api/<string:api_version>/generate/sync")
     api.add_resource(AsyncGenerate, "/generate/async","/api/<string:api_version>/generate/async")
     api.add_resource(AsyncGeneratePrompt, "/generate/prompt/<string:id>","/api/<string:api_version>/generate/prompt/<string:id>")
+    api.add_resource(AsyncStream, "/api/<string:api_version>/generate/stream/<string:id>")
     api.add_resource(AsyncCheck, "/generate/prompt/<string:id>","/api/<string:api_version>/generate/check/<string:id>")
     api.add_resource(PromptPop, "/generate/pop","/api/<string:api_version>/generate/pop")
     api.add_resource(SubmitGeneration, "/generate/submit","/api/<string:api_version>/generate/submit")
+    api.add_resource(BatchSubmitGeneration, "/generate/submit/batch","/api/<string:api_version>/generate/submit/batch")
     api.add_resource(Users, "/users","/api/<string:api_version>/users")
     api.add_resource(UserSingle, "/users/<string:user_id>","/api/<string:api_version>/users/<string:user_id>")
     api.add_resource(Servers, "/servers","/api/<string:api_version>/servers")
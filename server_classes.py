@@ -1,9 +1,62 @@
-import json, os, sys
+import json, os, sys, random, sqlite3, re, queue, hashlib, requests, socket, ipaddress
+from urllib.parse import urlsplit
+from collections import OrderedDict
 from uuid import uuid4
 from datetime import datetime
-import threading, time
+import threading, time, heapq
 from logger import logger
 
+# Approximate parameter counts of the models commonly served in the horde
+# These are used as-is, so that we don't need to load these models' configs to know their kudos multiplier
+KNOWN_MODEL_PARAMETERS = {
+    "EleutherAI/gpt-neo-125M": 125000000,
+    "EleutherAI/gpt-neo-1.3B": 1300000000,
+    "EleutherAI/gpt-neo-2.7B": 2700000000,
+    "EleutherAI/gpt-j-6B": 6000000000,
+    "EleutherAI/gpt-neox-20b": 20000000000,
+    "facebook/opt-125m": 125000000,
+    "facebook/opt-350m": 350000000,
+    "facebook/opt-1.3b": 1300000000,
+    "facebook/opt-2.7b": 2700000000,
+    "facebook/opt-6.7b": 6700000000,
+    "facebook/opt-13b": 13000000000,
+    "facebook/opt-30b": 30000000000,
+    "KoboldAI/fairseq-dense-125M": 125000000,
+    "KoboldAI/fairseq-dense-355M": 355000000,
+    "KoboldAI/fairseq-dense-1.3B": 1300000000,
+    "KoboldAI/fairseq-dense-2.7B": 2700000000,
+    "KoboldAI/fairseq-dense-6.7B": 6700000000,
+    "KoboldAI/fairseq-dense-13B": 13000000000,
+    "KoboldAI/fairseq-dense-2.7B-Nerys": 2700000000,
+    "KoboldAI/fairseq-dense-13B-Nerys": 13000000000,
+    "KoboldAI/fairseq-dense-13B-Nerys-v2": 13000000000,
+    "KoboldAI/fairseq-dense-2.7B-Janeway": 2700000000,
+    "KoboldAI/fairseq-dense-6.7B-Janeway": 6700000000,
+    "KoboldAI/fairseq-dense-13B-Janeway": 13000000000,
+    "KoboldAI/GPT-Neo-2.7B-AID": 2700000000,
+    "KoboldAI/GPT-Neo-2.7B-Horni": 2700000000,
+    "KoboldAI/GPT-Neo-2.7B-Horni-LN": 2700000000,
+    "KoboldAI/GPT-Neo-2.7B-Janeway": 2700000000,
+    "KoboldAI/GPT-Neo-2.7B-Picard": 2700000000,
+    "KoboldAI/GPT-Neo-2.7B-Shinen": 2700000000,
+    "KoboldAI/GPT-J-6B-Adventure": 6000000000,
+    "KoboldAI/GPT-J-6B-Janeway": 6000000000,
+    "KoboldAI/GPT-J-6B-Shinen": 6000000000,
+    "KoboldAI/GPT-J-6B-Skein": 6000000000,
+    "KoboldAI/GPT-NeoX-20B-Erebus": 20000000000,
+    "KoboldAI/GPT-NeoX-20B-Skein": 20000000000,
+    "KoboldAI/OPT-350M-Nerys-v2": 350000000,
+    "KoboldAI/OPT-1.3B-Nerys-v2": 1300000000,
+    "KoboldAI/OPT-2.7B-Nerys-v2": 2700000000,
+    "KoboldAI/OPT-6.7B-Nerys-v2": 6700000000,
+    "KoboldAI/OPT-13B-Nerys-v2": 13000000000,
+    "KoboldAI/OPT-350M-Erebus": 350000000,
+    "KoboldAI/OPT-1.3B-Erebus": 1300000000,
+    "KoboldAI/OPT-2.7B-Erebus": 2700000000,
+    "KoboldAI/OPT-6.7B-Erebus": 6700000000,
+    "KoboldAI/OPT-13B-Erebus": 13000000000,
+}
+
 class WaitingPrompt:
     # Every 10 secs we store usage data to disk
     def __init__(self, db, wps, pgs, prompt, user, models, params, **kwargs):
@@ -33,8 +86,25 @@ class WaitingPrompt:
         self.last_process_time = datetime.now()
         self.servers = kwargs.get("servers", [])
         self.softprompts = kwargs.get("softprompts", [''])
+        # If set, our generations are stored in this GenerationCache under cache_key once we're completed
+        self.cache = kwargs.get("cache")
+        self.cache_key = kwargs.get("cache_key")
+        # Generations we got from the cache instead of from servers
+        self.cached_generations = []
+        # If set, our generations are POSTed to callback_url through this WebhookDispatcher once we're completed
+        self.webhooks = kwargs.get("webhooks")
+        self.callback_url = kwargs.get("callback_url")
         # Prompt requests are removed after 10 mins of inactivity, to prevent memory usage
         self.stale_time = 600
+        # Set once all our generations have been submitted, or once we've expired
+        # This allows the sync requests to wake up immediately instead of polling
+        self.finished = threading.Event()
+        # Increments whenever one of our generations starts or finishes, or we're done, so that status streams can wake up
+        self.status_version = 0
+        self.status_changed = threading.Condition()
+        # Guards n and processing_gens, so that each of our gens is only ever handed out once,
+        # and so that we're only ever completed once. If we need the queue's lock as well, ours has to be taken first
+        self.lock = threading.RLock()
 
 
     def activate(self):
@@ -42,9 +112,7 @@ class WaitingPrompt:
         # Before we add it to the queue
         self._waiting_prompts.add_item(self)
         logger.info(f"New prompt request by user: {self.user.get_unique_alias()}")
-        thread = threading.Thread(target=self.check_for_stale, args=())
-        thread.daemon = True
-        thread.start()
+        self._db.expiry_scheduler.schedule(self, self.get_expiry_time())
 
     # The mps still queued to be generated for this WP
     def get_queued_tokens(self):
@@ -56,13 +124,18 @@ class WaitingPrompt:
             return(True)
         return(False)
 
+    # Claims one of the gens we still need for this server. Returns None if another server claimed the last one first
     def start_generation(self, server, matching_softprompt):
-        if self.n <= 0:
-            return
-        new_gen = ProcessingGeneration(self, self._processing_generations, server)
-        self.processing_gens.append(new_gen)
-        self.n -= 1
-        self.refresh()
+        with self.lock:
+            if self.n <= 0:
+                return
+            new_gen = ProcessingGeneration(self, self._processing_generations, server)
+            self.processing_gens.append(new_gen)
+            self.n -= 1
+            self.refresh()
+            # Once all our gens have been picked up, we don't need to stay in the queue
+            self._waiting_prompts.update_wp(self)
+        self.notify_status_change()
         prompt_payload = {
             "payload": self.gen_payload,
             "softprompt": matching_softprompt,
@@ -71,19 +144,67 @@ class WaitingPrompt:
         return(prompt_payload)
 
     def is_completed(self):
-        if self.needs_gen():
+        n, processing_gens = self.get_snapshot()
+        if n > 0:
             return(False)
-        for procgen in self.processing_gens:
+        for procgen in processing_gens:
             if not procgen.is_completed():
                 return(False)
         return(True)
 
-    def count_processing_gens(self):
+    # A consistent copy of how many gens we still need and of the gens we've handed out,
+    # so that status requests can read them while servers keep popping and submitting
+    def get_snapshot(self):
+        with self.lock:
+            return(self.n, list(self.processing_gens))
+
+    # Called whenever one of our generations is submitted
+    def check_completion(self):
+        with self.lock:
+            just_completed = self.is_completed() and not self.finished.is_set()
+            if just_completed:
+                self.finished.set()
+        if just_completed:
+            if self.cache is not None and not self.cached_generations:
+                self.cache.store(self.cache_key, self.get_generations())
+            if self.webhooks is not None and self.callback_url:
+                self.webhooks.send(self.callback_url, {"id": self.id, "generations": self.get_generations()})
+        self.notify_status_change()
+
+    def notify_status_change(self):
+        with self.status_changed:
+            self.status_version += 1
+            self.status_changed.notify_all()
+
+    # Blocks until our status changes after the version we had seen, or until the timeout. Returns the current version
+    def wait_for_status_change(self, seen_version, timeout):
+        with self.status_changed:
+            self.status_changed.wait_for(lambda: self.status_version > seen_version, timeout)
+            return(self.status_version)
+
+    # Completes this WP with generations we've already done for an identical request, without queuing it
+    def activate_from_cache(self, generations):
+        self.n = 0
+        self.cached_generations = generations
+        self.activate()
+        self.check_completion()
+
+    # Blocks until this WP is completed or deleted. Returns True if it was completed
+    def wait_for_completion(self):
+        # We still wake up every so often, in case we somehow missed our expiry
+        while not self.finished.wait(self.stale_time):
+            if self.is_stale():
+                break
+        return(self.is_completed())
+
+    def count_processing_gens(self, processing_gens = None):
+        if processing_gens is None:
+            processing_gens = self.get_snapshot()[1]
         ret_dict = {
-            "finished": 0,
+            "finished": len(self.cached_generations),
             "processing": 0,
         }
-        for procgen in self.processing_gens:
+        for procgen in processing_gens:
             if procgen.is_completed():
                 ret_dict["finished"] += 1
             else:
@@ -91,9 +212,10 @@ class WaitingPrompt:
         return(ret_dict)
 
     def get_status(self, lite = False):
-        ret_dict = self.count_processing_gens()
-        ret_dict["waiting"] = self.n
-        ret_dict["done"] = self.is_completed()
+        n, processing_gens = self.get_snapshot()
+        ret_dict = self.count_processing_gens(processing_gens)
+        ret_dict["waiting"] = n
+        ret_dict["done"] = n <= 0 and ret_dict["processing"] == 0
         ret_dict["generations"] = []
         queue_pos, queued_tokens, queued_n = self.get_own_queue_stats()
         # We increment the priority by 1, because it starts at 0
@@ -112,20 +234,27 @@ class WaitingPrompt:
             avg_token_per_sec = 1
         wait_time = queued_tokens / avg_token_per_sec
         # We add the expected running time of our processing gens
-        for procgen in self.processing_gens:
+        for procgen in processing_gens:
             wait_time += procgen.get_expected_time_left()
         ret_dict["wait_time"] = round(wait_time)
         if not lite:
-            for procgen in self.processing_gens:
-                if procgen.is_completed():
-                    gen_dict = {
-                        "text": procgen.generation,
-                        "server_id": procgen.server.id,
-                        "server_name": procgen.server.name,
-                    }
-                    ret_dict["generations"].append(gen_dict)
+            ret_dict["generations"] = self.get_generations(processing_gens)
         return(ret_dict)
 
+    def get_generations(self, processing_gens = None):
+        if processing_gens is None:
+            processing_gens = self.get_snapshot()[1]
+        generations = list(self.cached_generations)
+        for procgen in processing_gens:
+            if procgen.is_completed():
+                gen_dict = {
+                    "text": procgen.generation,
+                    "server_id": procgen.server.id,
+                    "server_name": procgen.server.name,
+                }
+                generations.append(gen_dict)
+        return(generations)
+
 
     # Same as status, but without the images to avoid unnecessary size
     def get_lite_status(self):
@@ -139,21 +268,28 @@ class WaitingPrompt:
             return(self._waiting_prompts.get_wp_queue_stats(self))
         return(-1,0,0)
 
-    def record_usage(self, tokens, kudos):
-        self.user.record_usage(tokens, kudos)
-        self.refresh()
-
+    # Called by the expiry scheduler once our deadline passes
+    # If we've been refreshed in the meantime, we return our new deadline so that we're checked again then
     def check_for_stale(self):
-        while True:
-            if self.is_stale():
-                self.delete()
-                break
-            time.sleep(600)
+        if self.is_stale():
+            self.delete()
+            return(None)
+        return(self.get_expiry_time())
+
+    # The earliest time at which is_stale() will be true, as a timestamp
+    def get_expiry_time(self):
+        return(self.last_process_time.timestamp() + self.stale_time + 1)
 
     def delete(self):
-        for gen in self.processing_gens:
+        with self.lock:
+            # So that no server can claim a gen from us while we're going away
+            self.n = 0
+            processing_gens = list(self.processing_gens)
+        for gen in processing_gens:
             gen.delete()
         self._waiting_prompts.del_item(self)
+        self.finished.set()
+        self.notify_status_change()
         del self
 
     def refresh(self):
@@ -179,17 +315,25 @@ class ProcessingGeneration:
         self._processing_generations.add_item(self)
 
     def set_generation(self, generation):
-        if self.is_completed():
+        if not self.claim_generation(generation):
             return(0)
-        self.generation = generation
-        tokens = self.owner.max_length
-        self.kudos = self.owner._db.convert_tokens_to_kudos(tokens, self.model)
-        tokens_per_sec = self.owner._db.stats.record_fulfilment(tokens,self.start_time)
-        self.server.record_contribution(tokens, self.kudos, tokens_per_sec)
-        self.owner.record_usage(tokens, self.kudos)
-        logger.info(f"New Generation worth {self.kudos} kudos, delivered by server: {self.server.name}")
+        self.owner._db.reward_generations([self])
         return(self.kudos)
 
+    # Stores the generation and works out what it's worth, but leaves handing out the kudos to the database,
+    # so that a batch of generations can be rewarded together. Returns False if it was already submitted
+    def claim_generation(self, generation):
+        # If the same generation is submitted twice at the same time, only one of them is rewarded
+        with self.owner.lock:
+            if self.is_completed():
+                return(False)
+            self.generation = generation
+        self.tokens = self.owner.max_length
+        self.multiplier = self.owner._db.stats.calculate_model_multiplier(self.model)
+        self.kudos = self.owner._db.convert_tokens_to_kudos(self.tokens, self.model, self.multiplier)
+        self.tokens_per_sec = self.owner._db.stats.record_fulfilment(self.tokens,self.server.get_generation_start(self.start_time))
+        return(True)
+
     def is_completed(self):
         if self.generation:
             return(True)
@@ -221,6 +365,14 @@ class KAIServer:
         self.last_reward_uptime = 0
         # Every how many seconds does this server get a kudos reward
         self.uptime_reward_threshold = 600
+        # The softprompt the bridge reported as loaded at its last check-in, if it told us
+        self.current_softprompt = None
+        # After how many seconds without a check-in this server is moved into cold storage
+        self.cold_storage_threshold = 7*24*60*60
+        # Our entry in the expiry scheduler. See ServerExpiry
+        self.expiry = None
+        # When we last submitted a generation. See get_generation_start()
+        self.last_submission_time = None
 
     def create(self, user, name, softprompts):
         self.user = user
@@ -234,15 +386,17 @@ class KAIServer:
         self.uptime = 0
         self._db.register_new_server(self)
 
-    def check_in(self, model, max_length, max_content_length, softprompts):
+    def check_in(self, model, max_length, max_content_length, softprompts, current_softprompt = None):
         if not self.is_stale():
             self.uptime += (datetime.now() - self.last_check_in).seconds
             # Every 10 minutes of uptime gets kudos rewarded
             if self.uptime - self.last_reward_uptime > self.uptime_reward_threshold:
                 # Bigger model uptime gets more kudos
-                kudos = round(self._db.stats.calculate_model_multiplier(model) / 2.75, 2)
+                multiplier = self._db.stats.calculate_model_multiplier(model)
+                kudos = round(multiplier / 2.75, 2)
                 self.modify_kudos(kudos,'uptime')
                 self.user.record_uptime(kudos)
+                self._db.stats.track_reward(model, multiplier, kudos, self, 'uptime')
                 logger.debug(f"server '{self.name}' received {kudos} kudos for uptime of {self.uptime_reward_threshold} seconds.")
                 self.last_reward_uptime = self.uptime
         else:
@@ -254,6 +408,9 @@ class KAIServer:
         self.max_content_length = max_content_length
         self.max_length = max_length
         self.softprompts = softprompts
+        self.current_softprompt = current_softprompt
+        self._db.mark_server_active(self)
+        self._db.mark_server_dirty(self)
 
     def get_human_readable_uptime(self):
         if self.uptime < 60:
@@ -296,18 +453,33 @@ class KAIServer:
             skipped_reason = 'matching_softprompt'
         return([is_matching,skipped_reason])
 
-    def record_contribution(self, tokens, kudos, tokens_per_sec):
-        self.user.record_contributions(tokens, kudos)
-        self.modify_kudos(kudos,'generated')
+    # A server generates one job at a time, but it might have popped several ahead of time,
+    # so a job can't have started generating before the previous one was submitted.
+    # Otherwise the time jobs spend waiting in the bridge would count against our speed
+    def get_generation_start(self, claim_time):
+        generation_start = claim_time
+        if self.last_submission_time is not None and self.last_submission_time > claim_time:
+            generation_start = self.last_submission_time
+        self.last_submission_time = datetime.now()
+        return(generation_start)
+
+    # Records one or more fulfilled generations at once, one speed per generation.
+    # Our owner's contributions are recorded by the database, as they might own more than one of the servers rewarded
+    def record_contribution(self, tokens, kudos, performances):
         self.contributions += tokens
-        self.fulfilments += 1
-        self.performances.append(tokens_per_sec)
+        self.fulfilments += len(performances)
+        # This also re-sorts us, so it needs to come after our contributions are updated
+        self.modify_kudos(kudos,'generated')
+        self.performances.extend(performances)
         if len(self.performances) > 20:
-            del self.performances[0]
+            del self.performances[:-20]
 
     def modify_kudos(self, kudos, action = 'generated'):
-        self.kudos = round(self.kudos + kudos, 2)
-        self.kudos_details[action] = round(self.kudos_details.get(action,0) + abs(kudos), 2) 
+        with self._db.kudos_lock:
+            self.kudos = round(self.kudos + kudos, 2)
+            self.kudos_details[action] = round(self.kudos_details.get(action,0) + abs(kudos), 2) 
+            self._db.mark_server_dirty(self)
+            self._db.sort_server(self)
 
     def get_performance_average(self):
         if len(self.performances):
@@ -326,13 +498,29 @@ class KAIServer:
 
     def is_stale(self):
         try:
-            if (datetime.now() - self.last_check_in).seconds > 300:
+            if (datetime.now() - self.last_check_in).total_seconds() > 300:
                 return(True)
         # If the last_check_in isn't set, it's a new server, so it's stale by default
         except AttributeError:
             return(True)
         return(False)
 
+    # The earliest time at which is_stale() will be true, as a timestamp
+    def get_expiry_time(self):
+        return(self.last_check_in.timestamp() + 300 + 1)
+
+    # Called by the expiry scheduler once our deadline passes
+    # Once we stop checking in, we're removed from the active servers, and once we've been gone long enough, we go into cold storage
+    def check_for_stale(self):
+        if not self.is_stale():
+            return(self.get_expiry_time())
+        self._db.mark_server_inactive(self)
+        cold_storage_time = self.last_check_in.timestamp() + self.cold_storage_threshold
+        if time.time() < cold_storage_time:
+            return(cold_storage_time)
+        self._db.move_server_to_cold_storage(self)
+        return(None)
+
     def serialize(self):
         ret_dict = {
             "oauth_id": self.user.oauth_id,
@@ -369,68 +557,735 @@ class KAIServer:
         self.id = saved_dict["id"]
         self.softprompts = saved_dict.get("softprompts",[])
         self.uptime = saved_dict.get("uptime",0)
-        self._db.servers[self.name] = self
+        self._db.index_server(self)
+
+class ServerExpiry:
+    # What we schedule in the expiry scheduler for a server
+    # When a server comes back while it's still scheduled for cold storage, it's scheduled again with a new one,
+    # and the old one does nothing when its deadline comes, so that each server only ever has one deadline to follow
+    def __init__(self, server):
+        self.server = server
+
+    def check_for_stale(self):
+        if self.server.expiry is not self:
+            return(None)
+        new_deadline = self.server.check_for_stale()
+        if not new_deadline:
+            self.server.expiry = None
+        return(new_deadline)
+
+
+class ExpiryScheduler:
+    # A single thread which expires items once their deadline passes, instead of one sleeping thread per item
+    # Items need to provide a check_for_stale() method, which either expires the item and returns None,
+    # or returns a new deadline if the item has been refreshed since it was scheduled
+    def __init__(self):
+        # Min-heap of (deadline timestamp, insertion order, item)
+        self._deadlines = []
+        self._insertions = 0
+        self._condition = threading.Condition()
+        thread = threading.Thread(target=self.run, args=())
+        thread.daemon = True
+        thread.start()
+
+    def schedule(self, item, deadline):
+        with self._condition:
+            self._insertions += 1
+            heapq.heappush(self._deadlines, (deadline, self._insertions, item))
+            # If this is now the earliest deadline, we need to wake the thread to wait for it instead
+            if self._deadlines[0][2] is item:
+                self._condition.notify()
+
+    def count_scheduled(self):
+        return(len(self._deadlines))
+
+    def run(self):
+        logger.init_ok("Expiry Scheduler Thread", status="Started")
+        while True:
+            with self._condition:
+                while not self._deadlines:
+                    self._condition.wait()
+                deadline, insertion, item = self._deadlines[0]
+                wait_time = deadline - time.time()
+                if wait_time > 0:
+                    self._condition.wait(wait_time)
+                    continue
+                heapq.heappop(self._deadlines)
+            # We check the item outside the lock, so that it can freely schedule itself or others again
+            new_deadline = self.check_item(item)
+            if new_deadline:
+                self.schedule(item, new_deadline)
+
+    @logger.catch
+    def check_item(self, item):
+        return(item.check_for_stale())
+
+
+class WebhookDispatcher:
+    # Delivers webhooks from a fixed pool of threads, so that whoever sends them never waits for the receiving end.
+    # Failed deliveries are retried with exponential backoff, and the ones we give up on are appended to the dead letter file
+    # Unless allow_private_hosts is set, we never deliver to hosts inside our own network, so that webhooks can't be used to reach them
+    def __init__(self, workers = 4, max_pending = 1000, max_attempts = 5, backoff = 2, timeout = 10, dead_letter_file = "db/webhook_dead_letters.jsonl", allow_private_hosts = False):
+        self.max_pending = max_pending
+        self.allow_private_hosts = allow_private_hosts
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.timeout = timeout
+        self.dead_letter_file = dead_letter_file
+        # Min-heap of (due timestamp, insertion order, delivery)
+        self._deliveries = []
+        self._insertions = 0
+        self._condition = threading.Condition()
+        self._dead_letter_lock = threading.Lock()
+        self._dead_letters = 0
+        self._session = requests.Session()
+        for _ in range(workers):
+            thread = threading.Thread(target=self.run, args=())
+            thread.daemon = True
+            thread.start()
+
+    # Never blocks. If too many deliveries are already pending, this one goes straight to the dead letters
+    def send(self, url, payload):
+        delivery = {
+            "url": url,
+            "payload": payload,
+            "attempts": 0,
+        }
+        if len(self._deliveries) >= self.max_pending:
+            self.record_dead_letter(delivery, "too many pending deliveries")
+            return
+        self.schedule(delivery, time.time())
+
+    def schedule(self, delivery, due):
+        with self._condition:
+            self._insertions += 1
+            heapq.heappush(self._deliveries, (due, self._insertions, delivery))
+            self._condition.notify()
+
+    def count_pending(self):
+        return(len(self._deliveries))
+
+    # Only counts dead letters once they're fully written to the file
+    def count_dead_letters(self):
+        with self._dead_letter_lock:
+            return(self._dead_letters)
+
+    # Returns True if the url is http(s), and its host only resolves to public addresses
+    def is_allowed_url(self, url):
+        try:
+            parsed_url = urlsplit(url)
+            port = parsed_url.port
+        except ValueError:
+            return(False)
+        if parsed_url.scheme not in ("http", "https") or not parsed_url.hostname:
+            return(False)
+        if self.allow_private_hosts:
+            return(True)
+        try:
+            addresses = socket.getaddrinfo(parsed_url.hostname, port or 80, proto = socket.IPPROTO_TCP)
+        except (socket.gaierror, UnicodeError):
+            return(False)
+        for address_info in addresses:
+            address = ipaddress.ip_address(address_info[4][0].split('%')[0])
+            if address.version == 6 and address.ipv4_mapped:
+                address = address.ipv4_mapped
+            if not address.is_global or address.is_multicast or address.is_reserved:
+                return(False)
+        return(True)
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._deliveries:
+                    self._condition.wait()
+                due, insertion, delivery = self._deliveries[0]
+                wait_time = due - time.time()
+                if wait_time > 0:
+                    self._condition.wait(wait_time)
+                    continue
+                heapq.heappop(self._deliveries)
+            # The url was checked when it was submitted, but its host might resolve somewhere else by now
+            if not self.is_allowed_url(delivery["url"]):
+                self.record_dead_letter(delivery, "forbidden host")
+                continue
+            error = self.deliver(delivery)
+            if error is None:
+                continue
+            if delivery["attempts"] >= self.max_attempts:
+                self.record_dead_letter(delivery, error)
+                continue
+            retry_in = self.backoff ** delivery["attempts"]
+            logger.debug(f"Webhook to {delivery['url']} failed ({error}). Retrying in {retry_in} seconds")
+            self.schedule(delivery, time.time() + retry_in)
+
+    # Returns None on success, or the reason we failed
+    def deliver(self, delivery):
+        delivery["attempts"] += 1
+        try:
+            # Redirects could lead us to a host we wouldn't have allowed
+            req = self._session.post(delivery["url"], json = delivery["payload"], timeout = self.timeout, allow_redirects = False)
+        except requests.exceptions.RequestException as e:
+            return(type(e).__name__)
+        if not req.ok or req.is_redirect:
+            return(f"status {req.status_code}")
+        return(None)
+
+    @logger.catch
+    def record_dead_letter(self, delivery, error):
+        logger.warning(f"Giving up on webhook to {delivery['url']} after {delivery['attempts']} attempts: {error}")
+        dead_letter = {
+            "url": delivery["url"],
+            "payload": delivery["payload"],
+            "attempts": delivery["attempts"],
+            "error": error,
+            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        with self._dead_letter_lock:
+            dead_letter_dir = os.path.dirname(self.dead_letter_file)
+            if dead_letter_dir and not os.path.exists(dead_letter_dir):
+                os.makedirs(dead_letter_dir)
+            with open(self.dead_letter_file, "a") as f:
+                f.write(json.dumps(dead_letter) + "\n")
+            self._dead_letters += 1
+
 
 class Index:
     def __init__(self):
         self._index = {}
+        # Many request threads add, look up and delete items at the same time.
+        # For the prompts index, anything which walks the queue, such as a server looking for WPs to pop, needs to hold this while doing so.
+        # It guards the queue and its buckets, but not the WPs themselves. Their gens are claimed via WaitingPrompt.start_generation()
+        self.lock = threading.RLock()
 
     def add_item(self, item):
-        self._index[item.id] = item
+        with self.lock:
+            self._index[item.id] = item
 
     def get_item(self, uuid):
-        return(self._index.get(uuid))
+        with self.lock:
+            return(self._index.get(uuid))
 
     def del_item(self, item):
-        del self._index[item.id]
+        with self.lock:
+            self._index.pop(item.id, None)
 
+    # Returns a copy, so that it can be iterated while items keep being added and deleted
     def get_all(self):
-        return(self._index.values())
+        with self.lock:
+            return(list(self._index.values()))
+
+
+class PriorityHeap:
+    # An indexed binary min-heap. We remember the position of every item in the heap
+    # So that we can remove it or change its key in O(log n) instead of re-sorting everything
+    def __init__(self):
+        # Each entry is [key, item]
+        self._heap = []
+        # item.id -> position in self._heap
+        self._positions = {}
+
+    def __len__(self):
+        return(len(self._heap))
+
+    def __contains__(self, item):
+        return(item.id in self._positions)
+
+    def get_key(self, item):
+        pos = self._positions.get(item.id)
+        if pos is None:
+            return(None)
+        return(self._heap[pos][0])
+
+    def push(self, item, key):
+        if item.id in self._positions:
+            self.update(item, key)
+            return
+        self._heap.append([key, item])
+        self._positions[item.id] = len(self._heap) - 1
+        self._sift_up(len(self._heap) - 1)
+
+    def remove(self, item):
+        pos = self._positions.pop(item.id, None)
+        if pos is None:
+            return
+        last = self._heap.pop()
+        if pos == len(self._heap):
+            return
+        self._heap[pos] = last
+        self._positions[last[1].id] = pos
+        self._sift_up(pos)
+        self._sift_down(self._positions[last[1].id])
+
+    def update(self, item, key):
+        pos = self._positions.get(item.id)
+        if pos is None:
+            return
+        self._heap[pos][0] = key
+        self._sift_up(pos)
+        self._sift_down(self._positions[item.id])
+
+    def peek(self):
+        if not len(self._heap):
+            return(None)
+        return(self._heap[0][1])
+
+    # Iterates the items in no particular order
+    def __iter__(self):
+        return(iter([entry[1] for entry in self._heap]))
+
+    # Yields (key, item) in key order without modifying the heap.
+    # Each yielded item costs O(log k), where k is the amount of items yielded so far
+    # So a caller which stops at the first match doesn't pay for the rest of the heap
+    # The heap should not be modified while iterating
+    def iter_sorted_with_keys(self):
+        if not len(self._heap):
+            return
+        frontier = [(self._heap[0][0], 0)]
+        while frontier:
+            key, pos = heapq.heappop(frontier)
+            yield(key, self._heap[pos][1])
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < len(self._heap):
+                    heapq.heappush(frontier, (self._heap[child][0], child))
+
+    def iter_sorted(self):
+        for key, item in self.iter_sorted_with_keys():
+            yield(item)
+
+    def _swap(self, i, j):
+        self._heap[i], self._heap[j] = self._heap[j], self._heap[i]
+        self._positions[self._heap[i][1].id] = i
+        self._positions[self._heap[j][1].id] = j
+
+    def _sift_up(self, pos):
+        while pos > 0:
+            parent = (pos - 1) // 2
+            if self._heap[pos][0] < self._heap[parent][0]:
+                self._swap(pos, parent)
+                pos = parent
+            else:
+                break
+
+    def _sift_down(self, pos):
+        size = len(self._heap)
+        while True:
+            smallest = pos
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < size and self._heap[child][0] < self._heap[smallest][0]:
+                    smallest = child
+            if smallest == pos:
+                break
+            self._swap(pos, smallest)
+            pos = smallest
+
+
+class OrderStatisticNode:
+    __slots__ = ("key", "item", "weight", "left", "right", "size", "values", "sums")
+
+    def __init__(self, key, item, values):
+        self.key = key
+        self.item = item
+        # Random heap priority which keeps the treap balanced in expectation
+        self.weight = random.random()
+        self.left = None
+        self.right = None
+        self.size = 1
+        self.values = values
+        self.sums = values
+
+
+class OrderStatisticTree:
+    # A treap sorted by key, where every node also knows the size and the sum of the values of its subtree.
+    # This lets us answer "how many items, and how much of each value, are ahead of this one" in O(log n)
+    # Values are tuples of numbers, which are summed element-wise
+    def __init__(self, value_count):
+        self._root = None
+        self._zero = tuple([0] * value_count)
+        # item.id -> node
+        self._nodes = {}
+
+    def __len__(self):
+        return(len(self._nodes))
+
+    def __contains__(self, item):
+        return(item.id in self._nodes)
+
+    def get_key(self, item):
+        node = self._nodes.get(item.id)
+        if node is None:
+            return(None)
+        return(node.key)
+
+    def insert(self, item, key, values):
+        if item.id in self._nodes:
+            self.remove(item)
+        node = OrderStatisticNode(key, item, tuple(values))
+        self._nodes[item.id] = node
+        left, right = self._split(self._root, key)
+        self._root = self._merge(self._merge(left, node), right)
+
+    def remove(self, item):
+        node = self._nodes.pop(item.id, None)
+        if node is None:
+            return
+        self._root = self._delete(self._root, node.key)
+
+    def update(self, item, key = None, values = None):
+        node = self._nodes.get(item.id)
+        if node is None:
+            return
+        if key is None:
+            key = node.key
+        if values is None:
+            values = node.values
+        self.insert(item, key, values)
+
+    def get_totals(self):
+        if self._root is None:
+            return(self._zero)
+        return(self._root.sums)
+
+    # Returns the 0-based position of the item, along with the sums of the values
+    # of every item up to and including it
+    def get_rank(self, item):
+        node = self._nodes.get(item.id)
+        if node is None:
+            return(-1, self._zero)
+        key = node.key
+        rank = 0
+        sums = self._zero
+        current = self._root
+        while current is not None:
+            if key < current.key:
+                current = current.left
+                continue
+            rank += self._size(current.left)
+            sums = self._add(sums, self._sums(current.left))
+            sums = self._add(sums, current.values)
+            if key == current.key:
+                return(rank, sums)
+            rank += 1
+            current = current.right
+        return(-1, self._zero)
+
+    # Yields (key, item) in key order, optionally starting right after the provided key.
+    # The tree should not be modified while iterating
+    def iter_sorted_with_keys(self, after_key = None):
+        stack = []
+        current = self._root
+        if after_key is not None:
+            # We only stack the nodes which come after the key, as the in-order walk below would have done
+            while current is not None:
+                if current.key > after_key:
+                    stack.append(current)
+                    current = current.left
+                else:
+                    current = current.right
+        while stack or current is not None:
+            while current is not None:
+                stack.append(current)
+                current = current.left
+            current = stack.pop()
+            yield(current.key, current.item)
+            current = current.right
+
+    def iter_sorted(self):
+        for key, item in self.iter_sorted_with_keys():
+            yield(item)
+
+    def _size(self, node):
+        if node is None:
+            return(0)
+        return(node.size)
+
+    def _sums(self, node):
+        if node is None:
+            return(self._zero)
+        return(node.sums)
+
+    def _add(self, a, b):
+        return(tuple([x + y for x, y in zip(a, b)]))
+
+    def _refresh(self, node):
+        node.size = 1 + self._size(node.left) + self._size(node.right)
+        node.sums = self._add(self._add(self._sums(node.left), node.values), self._sums(node.right))
+
+    # Splits the subtree into the nodes with keys < key and the nodes with keys >= key
+    def _split(self, node, key):
+        if node is None:
+            return(None, None)
+        if node.key < key:
+            left, right = self._split(node.right, key)
+            node.right = left
+            self._refresh(node)
+            return(node, right)
+        left, right = self._split(node.left, key)
+        node.left = right
+        self._refresh(node)
+        return(left, node)
+
+    # Merges two subtrees, where every key in left is smaller than every key in right
+    def _merge(self, left, right):
+        if left is None:
+            return(right)
+        if right is None:
+            return(left)
+        if left.weight > right.weight:
+            left.right = self._merge(left.right, right)
+            self._refresh(left)
+            return(left)
+        right.left = self._merge(left, right.left)
+        self._refresh(right)
+        return(right)
+
+    def _delete(self, node, key):
+        if node is None:
+            return(None)
+        if key == node.key:
+            return(self._merge(node.left, node.right))
+        if key < node.key:
+            node.left = self._delete(node.left, key)
+        else:
+            node.right = self._delete(node.right, key)
+        self._refresh(node)
+        return(node)
 
 
 class PromptsIndex(Index):
+    def __init__(self):
+        super().__init__()
+        # Only the WPs which still need generations are in the queue
+        # They're keyed on (-kudos, insertion order) so that the richest user comes first
+        # and users with the same kudos are served in the order they came
+        # Each WP carries its (queued tokens, queued gens, max_length) so we can answer queue stats quickly
+        self._queue = OrderStatisticTree(3)
+        self._insertions = 0
+        # user -> {wp.id: wp}, so we can re-key a user's WPs when their kudos change
+        self._user_wps = {}
+        # The same queue, split into buckets of WPs with the same requirements from a server
+        # capability key -> PriorityHeap. See get_capability_key()
+        self._buckets = {}
+        # wp.id -> capability key
+        self._wp_buckets = {}
+        # model -> the capability keys of the buckets which can use it, so that a pop only looks at buckets for its model.
+        # Buckets which accept any model are under None
+        self._model_buckets = {}
+        # Notified whenever a new WP is queued, so that long-polling servers can wake up
+        self._arrival = threading.Condition()
+        # Increments whenever anything in the queue changes, so that cached responses know when to be rebuilt
+        self._version = 0
+
+    def add_item(self, item):
+        with self.lock:
+            super().add_item(item)
+            self._user_wps.setdefault(item.user, {})[item.id] = item
+            if not item.needs_gen():
+                return
+            self._insertions += 1
+            self._enqueue(item, (-item.user.kudos, self._insertions))
+        with self._arrival:
+            self._arrival.notify_all()
+
+    def get_version(self):
+        return(self._version)
+
+    # Every queued WP is an arrival, so this only ever increases
+    def count_arrivals(self):
+        return(self._insertions)
+
+    # Blocks until a WP arrives after we had seen the provided amount of arrivals, or until the timeout
+    def wait_for_arrivals(self, seen_arrivals, timeout):
+        with self._arrival:
+            self._arrival.wait_for(lambda: self._insertions > seen_arrivals, timeout)
+
+    def del_item(self, item):
+        with self.lock:
+            super().del_item(item)
+            self._dequeue(item)
+            user_wps = self._user_wps.get(item.user)
+            if user_wps is not None:
+                user_wps.pop(item.id, None)
+                if not len(user_wps):
+                    del self._user_wps[item.user]
+
+    # Called whenever a WP hands out a generation, so that we stop considering it once it doesn't need any more
+    def update_wp(self, wp):
+        with self.lock:
+            if not wp.needs_gen():
+                self._dequeue(wp)
+            else:
+                self._queue.update(wp, values = self.get_queue_values(wp))
+                self._version += 1
+
+    # Called whenever a user's kudos change, to move their WPs to their new place in the queue
+    def update_user_priority(self, user):
+        with self.lock:
+            for wp in self._user_wps.get(user, {}).values():
+                key = self._queue.get_key(wp)
+                if key is not None:
+                    new_key = (-user.kudos, key[1])
+                    self._queue.update(wp, key = new_key)
+                    self._buckets[self._wp_buckets[wp.id]].update(wp, new_key)
+                    self._version += 1
+
+    def get_queue_values(self, wp):
+        return((wp.get_queued_tokens(), wp.n, wp.max_length))
+
+    def _enqueue(self, wp, key):
+        self._version += 1
+        self._queue.insert(wp, key, self.get_queue_values(wp))
+        capability_key = self.get_capability_key(wp)
+        self._wp_buckets[wp.id] = capability_key
+        if capability_key not in self._buckets:
+            self._buckets[capability_key] = PriorityHeap()
+            for model in capability_key[0] or (None,):
+                self._model_buckets.setdefault(model, set()).add(capability_key)
+        self._buckets[capability_key].push(wp, key)
+
+    def _dequeue(self, wp):
+        self._version += 1
+        self._queue.remove(wp)
+        capability_key = self._wp_buckets.pop(wp.id, None)
+        if capability_key is None:
+            return
+        bucket = self._buckets[capability_key]
+        bucket.remove(wp)
+        if not len(bucket):
+            del self._buckets[capability_key]
+            for model in capability_key[0] or (None,):
+                model_buckets = self._model_buckets[model]
+                model_buckets.discard(capability_key)
+                if not model_buckets:
+                    del self._model_buckets[model]
+
+    # WPs are bucketed on everything which a server can be excluded on, except server IDs,
+    # as those are rare and cheap to check on the few candidates we end up looking at.
+    # Clients can ask for any lengths, so those are bucketed by power of two tiers, to keep the amount of buckets small.
+    # Softprompts can't be bucketed, as they are matched by substring against each server's files,
+    # so we just mark the WPs which can't always fall back to no softprompt.
+    # Whenever a bucket might hold WPs which this server can't do, they're still checked one by one with can_generate()
+    def get_capability_key(self, wp):
+        models = tuple(sorted(set(wp.models)))
+        needs_softprompt = '' not in wp.softprompts
+        return((models, self.get_length_tier(wp.max_length), self.get_length_tier(wp.max_content_length), needs_softprompt))
+
+    # Tier t holds the lengths from 2^(t-1)+1 to 2^t
+    @staticmethod
+    def get_length_tier(length):
+        return(int(max(length, 1) - 1).bit_length())
+
+    # Returns the smallest and largest length in a tier
+    @staticmethod
+    def get_tier_bounds(tier):
+        if tier == 0:
+            return(0, 1)
+        return(2 ** (tier - 1) + 1, 2 ** tier)
+
+    # Returns the reason a server would skip every WP in a bucket, or None if the bucket's WPs might match
+    # The order of checks follows KAIServer.can_generate(), so that we report the same reason it would
+    def get_bucket_skipped_reason(self, capability_key, server):
+        models, max_length_tier, max_content_length_tier, needs_softprompt = capability_key
+        skipped_reason = None
+        if len(models) >= 1 and server.model not in models:
+            skipped_reason = 'models'
+        if server.max_content_length < self.get_tier_bounds(max_content_length_tier)[0]:
+            skipped_reason = 'max_content_length'
+        if server.max_length < self.get_tier_bounds(max_length_tier)[0]:
+            skipped_reason = 'max_length'
+        return(skipped_reason)
+
+    # Whether a server would skip all the WPs of a bucket for the same reason
+    # If the server's lengths fall inside one of the bucket's tiers, or the WPs need softprompts, each WP might differ
+    def is_bucket_uniform(self, capability_key, server):
+        models, max_length_tier, max_content_length_tier, needs_softprompt = capability_key
+        if needs_softprompt:
+            return(False)
+        for tier, server_length in ((max_length_tier, server.max_length), (max_content_length_tier, server.max_content_length)):
+            lowest, highest = self.get_tier_bounds(tier)
+            if lowest <= server_length < highest:
+                return(False)
+        return(True)
+
+    # Lazily yields the WPs which need generations and might fit the model and lengths of this server, in priority order
+    # Needs to be consumed while holding our lock
+    def iter_candidate_wps(self, server):
+        candidate_buckets = []
+        capability_keys = self._model_buckets.get(server.model, set()) | self._model_buckets.get(None, set())
+        for capability_key in capability_keys:
+            if self.get_bucket_skipped_reason(capability_key, server) is None:
+                candidate_buckets.append(self._buckets[capability_key].iter_sorted_with_keys())
+        # Keys are unique, so merge never needs to compare the WPs themselves
+        for key, wp in heapq.merge(*candidate_buckets):
+            yield(wp)
+
+    # Adds the skipped reasons for all the WPs that iter_candidate_wps() did not provide for this server.
+    # WPs in exclude_ids have already been checked by the caller, so they're not counted again.
+    # Needs to be called while holding our lock
+    def count_skipped_wps(self, server, skipped, exclude_ids = None):
+        if exclude_ids is None:
+            exclude_ids = set()
+        excluded_per_bucket = {}
+        for wp_id in exclude_ids:
+            capability_key = self._wp_buckets.get(wp_id)
+            if capability_key is not None:
+                excluded_per_bucket[capability_key] = excluded_per_bucket.get(capability_key,0) + 1
+        for capability_key, bucket in self._buckets.items():
+            skipped_reason = self.get_bucket_skipped_reason(capability_key, server)
+            if skipped_reason is None:
+                continue
+            # If the WPs might be skipped for different reasons, we need to ask can_generate() about each of them
+            if not self.is_bucket_uniform(capability_key, server):
+                for wp in bucket:
+                    if wp.id in exclude_ids:
+                        continue
+                    skipped_reason = server.can_generate(wp)[1]
+                    skipped[skipped_reason] = skipped.get(skipped_reason,0) + 1
+                continue
+            count = len(bucket) - excluded_per_bucket.get(capability_key,0)
+            if count > 0:
+                skipped[skipped_reason] = skipped.get(skipped_reason,0) + count
+
+    def get_user_wps(self, user):
+        with self.lock:
+            return(list(self._user_wps.get(user, {}).values()))
 
     def count_waiting_requests(self, user):
         count = 0
-        for wp in self._index.values():
-            if wp.user == user and not wp.is_completed():
+        for wp in self.get_user_wps(user):
+            if not wp.is_completed():
                 count += 1
         return(count)
 
     def count_totals(self):
+        with self.lock:
+            queued_tokens, queued_n, queued_max_length = self._queue.get_totals()
         ret_dict = {
-            "queued_requests": 0,
-            "queued_tokens": 0,
+            "queued_requests": queued_n,
+            "queued_tokens": queued_max_length,
         }
-        for wp in self._index.values():
-            ret_dict["queued_requests"] += wp.n
-            if wp.n > 0:
-                ret_dict["queued_tokens"] += wp.max_length
         return(ret_dict)
 
 
+    # Lazily yields the WPs which need generations, in priority order
+    # Needs to be consumed while holding our lock
+    def iter_waiting_wp_by_kudos(self):
+        return(self._queue.iter_sorted())
+
     def get_waiting_wp_by_kudos(self):
-        sorted_wp_list = sorted(self._index.values(), key=lambda x: x.user.kudos, reverse=True)
-        final_wp_list = []
-        for wp in sorted_wp_list:
-            if wp.needs_gen():
-                final_wp_list.append(wp)
-        return(final_wp_list)
+        with self.lock:
+            return(list(self.iter_waiting_wp_by_kudos()))
 
     # Returns the queue position of the provided WP based on kudos
     # Also returns the amount of mps until the wp is generated
     # Also returns the amount of different gens queued
     def get_wp_queue_stats(self, wp):
-        tokens_ahead_in_queue = 0
-        n_ahead_in_queue = 0
-        priority_sorted_list = self.get_waiting_wp_by_kudos()
-        for iter in range(len(priority_sorted_list)):
-            tokens_ahead_in_queue += priority_sorted_list[iter].get_queued_tokens()
-            n_ahead_in_queue += priority_sorted_list[iter].n
-            if priority_sorted_list[iter] == wp:
-                return(iter, tokens_ahead_in_queue, n_ahead_in_queue)
+        with self.lock:
+            position, sums = self._queue.get_rank(wp)
         # -1 means the WP is done and not in the queue
-        return(-1,0,0)
+        if position == -1:
+            return(-1,0,0)
+        tokens_ahead_in_queue, n_ahead_in_queue, max_length_ahead = sums
+        return(position, round(tokens_ahead_in_queue,2), n_ahead_in_queue)
 
 
 class GenerationsIndex(Index):
@@ -474,7 +1329,6 @@ class User:
         self.invite_id = invite_id
         self.creation_date = datetime.now()
         self.last_active = datetime.now()
-        self.id = self._db.register_new_user(self)
         self.contributions = {
             "tokens": 0,
             "fulfillments": 0
@@ -483,6 +1337,7 @@ class User:
             "tokens": 0,
             "requests": 0
         }
+        self.id = self._db.register_new_user(self)
 
     # Checks that this user matches the specified API key
     def check_key(api_key):
@@ -493,22 +1348,32 @@ class User:
     def get_unique_alias(self):
         return(f"{self.username}#{self.id}")
 
-    def record_usage(self, tokens, kudos):
+    def set_credentials(self, username, api_key):
+        old_username = self.username
+        old_api_key = self.api_key
+        self.username = username
+        self.api_key = api_key
+        self._db.reindex_user(self, old_username, old_api_key)
+
+    def record_usage(self, tokens, kudos, requests = 1):
         self.usage["tokens"] += tokens
-        self.usage["requests"] += 1
+        self.usage["requests"] += requests
         self.modify_kudos(-kudos,"accumulated")
 
-    def record_contributions(self, tokens, kudos):
+    def record_contributions(self, tokens, kudos, fulfillments = 1):
         self.contributions["tokens"] += tokens
-        self.contributions["fulfillments"] += 1
+        self.contributions["fulfillments"] += fulfillments
         self.modify_kudos(kudos,"accumulated")
 
     def record_uptime(self, kudos):
         self.modify_kudos(kudos,"accumulated")
 
     def modify_kudos(self, kudos, action = 'accumulated'):
-        self.kudos = round(self.kudos + kudos, 2)
-        self.kudos_details[action] = round(self.kudos_details.get(action,0) + kudos, 2)
+        with self._db.kudos_lock:
+            self.kudos = round(self.kudos + kudos, 2)
+            self.kudos_details[action] = round(self.kudos_details.get(action,0) + kudos, 2)
+            self._db.mark_user_dirty(self)
+            self._db.notify_kudos_change(self)
 
 
     def serialize(self):
@@ -551,14 +1416,145 @@ class User:
         self.last_active = datetime.strptime(saved_dict["last_active"],"%Y-%m-%d %H:%M:%S")
 
 
+class RollingCounter:
+    # A fixed ring of time buckets. Each slot remembers which bucket it currently holds,
+    # so old buckets are simply overwritten as time moves forward, and memory never grows
+    def __init__(self, bucket_seconds, bucket_count):
+        self.bucket_seconds = bucket_seconds
+        self.bucket_count = bucket_count
+        self.buckets = [0] * bucket_count
+        self.bucket_ids = [None] * bucket_count
+
+    def record(self, amount, timestamp = None):
+        if timestamp is None:
+            timestamp = time.time()
+        bucket_id = int(timestamp // self.bucket_seconds)
+        slot = bucket_id % self.bucket_count
+        # Too old to fit in the ring anymore
+        if self.bucket_ids[slot] is not None and bucket_id < self.bucket_ids[slot]:
+            return
+        if self.bucket_ids[slot] != bucket_id:
+            self.bucket_ids[slot] = bucket_id
+            self.buckets[slot] = 0
+        self.buckets[slot] += amount
+
+    # Returns the total recorded in the last `seconds`, including the current, partial, bucket
+    # Can't look further back than bucket_seconds * bucket_count
+    def get_total(self, seconds):
+        current_bucket_id = int(time.time() // self.bucket_seconds)
+        oldest_bucket_id = current_bucket_id - min(int(seconds // self.bucket_seconds), self.bucket_count) + 1
+        total = 0
+        for slot in range(self.bucket_count):
+            bucket_id = self.bucket_ids[slot]
+            if bucket_id is not None and oldest_bucket_id <= bucket_id <= current_bucket_id:
+                total += self.buckets[slot]
+        return(total)
+
+    def serialize(self):
+        ret_dict = {
+            "bucket_seconds": self.bucket_seconds,
+            "buckets": self.buckets,
+            "bucket_ids": self.bucket_ids,
+        }
+        return(ret_dict)
+
+    def deserialize(self, saved_dict):
+        # If the bucket layout changed, we just start from scratch
+        if saved_dict.get("bucket_seconds") != self.bucket_seconds or len(saved_dict.get("buckets",[])) != self.bucket_count:
+            return
+        self.buckets = saved_dict["buckets"]
+        self.bucket_ids = saved_dict["bucket_ids"]
+
+
+class GenerationCache:
+    # Remembers the generations of completed prompt requests which asked to be cacheable,
+    # so that identical requests can be answered without sending them to a server again.
+    # Entries are evicted once they're older than ttl seconds, or least recently used first once we store more than max_bytes of text.
+    def __init__(self, max_bytes = 64 * 1024 * 1024, ttl = 3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # cache_key -> (expiry timestamp, generations, size in bytes)
+        self.entries = OrderedDict()
+        self.stored_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Requests are only identical if they would be sent to the same models and softprompts
+    @staticmethod
+    def get_key(prompt, params, models, softprompts):
+        request = {
+            "prompt": prompt,
+            "params": params,
+            "models": sorted(models),
+            "softprompts": sorted(softprompts),
+        }
+        return(hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest())
+
+    def get(self, cache_key):
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry and entry[0] < time.time():
+                self._evict(cache_key)
+                entry = None
+            if not entry:
+                self.misses += 1
+                return(None)
+            self.entries.move_to_end(cache_key)
+            self.hits += 1
+            return(list(entry[1]))
+
+    def store(self, cache_key, generations):
+        size = sum([len(gen["text"].encode()) for gen in generations])
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if cache_key in self.entries:
+                self._evict(cache_key)
+            self.entries[cache_key] = (time.time() + self.ttl, generations, size)
+            self.stored_bytes += size
+            while self.stored_bytes > self.max_bytes:
+                self._evict(next(iter(self.entries)))
+            # The least recently used entries are the likeliest to have expired as well
+            now = time.time()
+            while self.entries:
+                oldest_key, oldest_entry = next(iter(self.entries.items()))
+                if oldest_entry[0] >= now:
+                    break
+                self._evict(oldest_key)
+
+    def _evict(self, cache_key):
+        entry = self.entries.pop(cache_key)
+        self.stored_bytes -= entry[2]
+
+    def get_stats(self):
+        with self.lock:
+            ret_dict = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.stored_bytes,
+            }
+        return(ret_dict)
+
+
 class Stats:
-    def __init__(self, db, convert_flag = None, interval = 60):
+    def __init__(self, db, convert_flag = None):
         self.db = db
         self.server_performances = []
         self.model_mulitpliers = {}
-        self.fulfillments = []
-        self.interval = interval
-        self.last_pruning = datetime.now()
+        # Tokens generated, per second for the last 5 minutes and per minute for the last hour
+        self.tokens_per_second = RollingCounter(1, 300)
+        self.tokens_per_minute = RollingCounter(60, 60)
+        # How many times servers had to load a different softprompt for the jobs we gave them, per minute for the last hour
+        self.softprompt_swaps = RollingCounter(60, 60)
+        # Models whose multiplier is still being resolved -> the kudos rewards given with their provisional multiplier
+        self.provisional_rewards = {}
+        self.model_lock = threading.Lock()
+        self.model_queue = queue.Queue()
+        thread = threading.Thread(target=self.resolve_model_multipliers, args=())
+        thread.daemon = True
+        thread.start()
 
 
     def record_fulfilment(self, tokens, starting_time):
@@ -570,35 +1566,106 @@ class Stats:
         if len(self.server_performances) >= 10:
             del self.server_performances[0]
         self.server_performances.append(tokens_per_sec)
-        fulfillment_dict = {
-            "tokens": tokens,
-            "start_time": starting_time,
-            "deliver_time": datetime.now(),
-        }
-        self.fulfillments.append(fulfillment_dict)
+        self.record_tokens(tokens)
+        self.db.mark_stats_dirty()
         return(tokens_per_sec)
 
+    def record_tokens(self, tokens, timestamp = None):
+        self.tokens_per_second.record(tokens, timestamp)
+        self.tokens_per_minute.record(tokens, timestamp)
+
+    def record_softprompt_swaps(self, swaps):
+        self.softprompt_swaps.record(swaps)
+        self.db.mark_stats_dirty()
+
+    def get_softprompt_swaps_per_hour(self):
+        return(self.softprompt_swaps.get_total(3600))
+
     def get_kilotokens_per_min(self):
-        total_tokens = 0
-        pruned_array = []
-        for fulfillment in self.fulfillments.copy():
-            if (datetime.now() - fulfillment["deliver_time"]).seconds <= 60:
-                pruned_array.append(fulfillment)
-                total_tokens += fulfillment["tokens"]
-                # logger.debug([(datetime.now() - fulfillment["deliver_time"]).seconds, total_tokens])
-        # To avoid race condition, we do it all in the same place, instead of using a thread
-        if (datetime.now() - self.last_pruning).seconds > self.interval:
-            self.last_pruning = datetime.now()
-            self.fulfillments = pruned_array
-            logger.debug("Pruned fulfillments")
-        kilotokens_per_min = round(total_tokens / 1000,2)
+        kilotokens_per_min = round(self.tokens_per_second.get_total(60) / 1000,2)
         return(kilotokens_per_min)
 
+    # The average kilotokens per minute over the last minute, 5 minutes and hour
+    def get_kilotokens_per_min_by_window(self):
+        ret_dict = {
+            "1m": self.get_kilotokens_per_min(),
+            "5m": round(self.tokens_per_second.get_total(300) / 5 / 1000,2),
+            "1h": round(self.tokens_per_minute.get_total(3600) / 60 / 1000,2),
+        }
+        return(ret_dict)
+
+    # This never blocks. If we don't know the model yet, we return a provisional multiplier
+    # and resolve the real one in the background. See track_reward()
     def calculate_model_multiplier(self, model_name):
         # To avoid doing this calculations all the time
         multiplier = self.model_mulitpliers.get(model_name)
         if multiplier:
             return(multiplier)
+        if model_name in KNOWN_MODEL_PARAMETERS:
+            multiplier = KNOWN_MODEL_PARAMETERS[model_name] / 1000000000
+            self.model_mulitpliers[model_name] = multiplier
+            self.db.mark_stats_dirty()
+            return(multiplier)
+        with self.model_lock:
+            # It might have been resolved while we were checking
+            if model_name in self.model_mulitpliers:
+                return(self.model_mulitpliers[model_name])
+            if model_name not in self.provisional_rewards:
+                self.provisional_rewards[model_name] = []
+                self.model_queue.put(model_name)
+        return(self.guess_model_multiplier(model_name))
+
+    # Most model names contain their size, like "OPT-13B" or "opt-350m"
+    def guess_model_multiplier(self, model_name):
+        size = re.search(r'(\d+(?:\.\d+)?)([bm])(?![a-z])', model_name.lower())
+        if not size:
+            return(1)
+        if size.group(2) == 'm':
+            return(float(size.group(1)) / 1000)
+        return(float(size.group(1)))
+
+    # Every reward given using a provisional multiplier is kept, so that it can be corrected later
+    def track_reward(self, model_name, multiplier, kudos, server, action, requesting_user = None):
+        reward = {
+            "multiplier": multiplier,
+            "kudos": kudos,
+            "server": server,
+            "action": action,
+            "requesting_user": requesting_user,
+        }
+        with self.model_lock:
+            if model_name in self.provisional_rewards:
+                self.provisional_rewards[model_name].append(reward)
+                return
+        # The model might have been resolved between calculating the multiplier and rewarding
+        real_multiplier = self.model_mulitpliers.get(model_name)
+        if real_multiplier and real_multiplier != multiplier:
+            self.reconcile_reward(reward, real_multiplier)
+
+    def reconcile_reward(self, reward, real_multiplier):
+        kudos_diff = round(reward["kudos"] * real_multiplier / reward["multiplier"] - reward["kudos"], 2)
+        if kudos_diff == 0:
+            return
+        reward["server"].modify_kudos(kudos_diff, reward["action"])
+        reward["server"].user.modify_kudos(kudos_diff, 'accumulated')
+        if reward["requesting_user"]:
+            reward["requesting_user"].modify_kudos(-kudos_diff, 'accumulated')
+
+    def resolve_model_multipliers(self):
+        while True:
+            model_name = self.model_queue.get()
+            multiplier = self.count_model_parameters(model_name) / 1000000000
+            with self.model_lock:
+                self.model_mulitpliers[model_name] = multiplier
+                rewards = self.provisional_rewards.pop(model_name, [])
+            self.db.mark_stats_dirty()
+            for reward in rewards:
+                self.reconcile_reward(reward, multiplier)
+            logger.info(f"Reconciled {len(rewards)} kudos rewards for model {model_name} with multiplier {multiplier}")
+
+    # This is slow and needs transformers, so it should only ever run in the resolver thread
+    @logger.catch(default=1000000000)
+    def count_model_parameters(self, model_name):
         try:
             import transformers, accelerate
             config = transformers.AutoConfig.from_pretrained(model_name)
@@ -606,12 +1673,10 @@ class Stats:
                 model = transformers.AutoModelForCausalLM.from_config(config)
             params_sum = sum(v.numel() for v in model.state_dict().values())
             logger.info(f"New Model {model_name} parameter = {params_sum}")
-            multiplier = params_sum / 1000000000
         except OSError:
             logger.error(f"Model '{model_name}' not found in hugging face. Defaulting to multiplier of 1.")
-            multiplier = 1
-        self.model_mulitpliers[model_name] = multiplier
-        return(multiplier)
+            params_sum = 1000000000
+        return(params_sum)
 
     def get_request_avg(self):
         if len(self.server_performances) == 0:
@@ -621,18 +1686,12 @@ class Stats:
 
     @logger.catch
     def serialize(self):
-        serialized_fulfillments = []
-        for fulfillment in self.fulfillments:
-            json_fulfillment = {
-                "tokens": fulfillment["tokens"],
-                "start_time": fulfillment["start_time"].strftime("%Y-%m-%d %H:%M:%S"),
-                "deliver_time": fulfillment["deliver_time"].strftime("%Y-%m-%d %H:%M:%S"),
-            }
-            serialized_fulfillments.append(json_fulfillment)
         ret_dict = {
             "server_performances": self.server_performances,
             "model_mulitpliers": self.model_mulitpliers,
-            "fulfillments": serialized_fulfillments,
+            "tokens_per_second": self.tokens_per_second.serialize(),
+            "tokens_per_minute": self.tokens_per_minute.serialize(),
+            "softprompt_swaps": self.softprompt_swaps.serialize(),
         }
         return(ret_dict)
 
@@ -643,180 +1702,741 @@ class Stats:
             self.server_performances = saved_dict["fulfilment_times"]
         else:
             self.server_performances = saved_dict["server_performances"]
-        deserialized_fulfillments = []
+        if "tokens_per_second" in saved_dict:
+            self.tokens_per_second.deserialize(saved_dict["tokens_per_second"])
+            self.tokens_per_minute.deserialize(saved_dict["tokens_per_minute"])
+        if "softprompt_swaps" in saved_dict:
+            self.softprompt_swaps.deserialize(saved_dict["softprompt_swaps"])
+        # Convert the old list of fulfillments into our counters
         for fulfillment in saved_dict.get("fulfillments", []):
             if convert_flag == "to_tokens":
                 fulfillment["tokens"] = round(fulfillment["chars"] / 4)
-            class_fulfillment = {
-                "tokens": fulfillment["tokens"],
-                "start_time": datetime.strptime(fulfillment["start_time"],"%Y-%m-%d %H:%M:%S"),
-                "deliver_time":datetime.strptime( fulfillment["deliver_time"],"%Y-%m-%d %H:%M:%S"),
-            }
-            deserialized_fulfillments.append(class_fulfillment)
+            deliver_time = datetime.strptime(fulfillment["deliver_time"],"%Y-%m-%d %H:%M:%S")
+            self.record_tokens(fulfillment["tokens"], deliver_time.timestamp())
         self.model_mulitpliers = saved_dict["model_mulitpliers"]
-        self.fulfillments = deserialized_fulfillments
     
 
+class JsonStorage:
+    # Stores the database as JSON snapshots, plus an append-only journal of the records changed since then
+    # Every journal has a generation, and each snapshot records the generation of the last journal it contains,
+    # so that a journal which was already compacted is never replayed on top of a newer snapshot
+    def __init__(self):
+        self.SERVERS_FILE = "db/servers.json"
+        self.STATS_FILE = "db/stats.json"
+        self.USERS_FILE = "db/users.json"
+        # Changed records are appended to the journal of the current generation every interval,
+        # and compacted into the files above every so often
+        self.JOURNAL_FILE_PATTERN = "db/journal.{}.jsonl"
+        # Where the journal was kept before it had generations. It's treated as generation 1
+        self.LEGACY_JOURNAL_FILE = "db/journal.jsonl"
+        self.journal_generation = 1
+        self.journal_entries = 0
+        self.max_journal_entries = 50000
+        self.compaction_interval = 600
+        self.last_compaction = datetime.now()
+
+    def load(self):
+        serialized_users, users_generation = self.read_snapshot_file(self.USERS_FILE, [])
+        serialized_servers, servers_generation = self.read_snapshot_file(self.SERVERS_FILE, [])
+        serialized_stats, stats_generation = self.read_snapshot_file(self.STATS_FILE, None)
+        journal_users = {}
+        journal_servers = {}
+        last_generation = max(users_generation, servers_generation, stats_generation)
+        # The journals contain the latest version of every record changed since the snapshot which includes them
+        for generation, filename in self.get_journal_files():
+            last_generation = max(last_generation, generation)
+            journal = self.read_journal(filename)
+            if generation > users_generation:
+                journal_users.update(journal["users"])
+            if generation > servers_generation:
+                journal_servers.update(journal["servers"])
+            if generation > stats_generation and journal["stats"]:
+                serialized_stats = journal["stats"]
+        self.journal_generation = last_generation + 1
+        # We want to start with a clean journal, so that it doesn't keep growing across restarts
+        if self.journal_entries:
+            self.last_compaction = None
+        return({
+            "users": self.merge_journal_records(serialized_users, journal_users, "oauth_id"),
+            "servers": self.merge_journal_records(serialized_servers, journal_servers, "name"),
+            "stats": serialized_stats,
+        })
+
+    # Returns (generation, filename) for every journal on disk, oldest first
+    def get_journal_files(self):
+        journal_files = []
+        if os.path.isfile(self.LEGACY_JOURNAL_FILE):
+            journal_files.append((1, self.LEGACY_JOURNAL_FILE))
+        if os.path.isdir('db'):
+            for filename in os.listdir('db'):
+                generation = filename[len("journal."):-len(".jsonl")]
+                if filename.startswith("journal.") and filename.endswith(".jsonl") and generation.isdigit():
+                    journal_files.append((int(generation), os.path.join('db', filename)))
+        return(sorted(journal_files))
+
+    def needs_compaction(self):
+        if self.last_compaction is None:
+            return(True)
+        return(self.journal_entries >= self.max_journal_entries or (datetime.now() - self.last_compaction).seconds > self.compaction_interval)
+
+    # Appends every record which changed since the last time to the journal
+    def write_changes(self, serialized_users, serialized_servers, serialized_stats):
+        journal_lines = []
+        for user_dict in serialized_users:
+            journal_lines.append(json.dumps({"type": "user", "data": user_dict}))
+        for server_dict in serialized_servers:
+            journal_lines.append(json.dumps({"type": "server", "data": server_dict}))
+        if serialized_stats:
+            journal_lines.append(json.dumps({"type": "stats", "data": serialized_stats}))
+        if not journal_lines:
+            return
+        if not os.path.exists('db'):
+            os.mkdir('db')
+        with open(self.JOURNAL_FILE_PATTERN.format(self.journal_generation), 'a') as journal:
+            journal.write('\n'.join(journal_lines) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.journal_entries += len(journal_lines)
+
+    # Compacts everything into full snapshots and starts a new journal
+    def write_all(self, serialized_users, serialized_servers, serialized_stats):
+        if not os.path.exists('db'):
+            os.mkdir('db')
+        # The snapshots contain everything journaled so far, so any further changes go to the next generation
+        compacted_generation = self.journal_generation
+        self.journal_generation += 1
+        self.write_json_file_atomically(self.SERVERS_FILE, {"generation": compacted_generation, "records": serialized_servers})
+        self.write_json_file_atomically(self.STATS_FILE, {"generation": compacted_generation, "records": serialized_stats})
+        self.write_json_file_atomically(self.USERS_FILE, {"generation": compacted_generation, "records": serialized_users})
+        # Only once all snapshots are in place can we discard the journals they contain.
+        # If we crash before this, the snapshots already know not to replay them
+        for generation, filename in self.get_journal_files():
+            if generation <= compacted_generation:
+                os.remove(filename)
+        self.journal_entries = 0
+        self.last_compaction = datetime.now()
+        logger.debug("Compacted database journal into snapshots")
+
+    # We write to a temporary file first, so that a crash never leaves a half-written snapshot behind
+    def write_json_file_atomically(self, filename, data):
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as db:
+            json.dump(data,db)
+            db.flush()
+            os.fsync(db.fileno())
+        os.replace(tmp_filename, filename)
+
+    def read_json_file(self, filename, default):
+        if not os.path.isfile(filename):
+            return(default)
+        with open(filename) as db:
+            return(json.load(db))
+
+    # Returns the snapshot's records, and the generation of the last journal they contain
+    # Snapshots from before journals had generations are just the records, and contain no journal
+    def read_snapshot_file(self, filename, default):
+        snapshot = self.read_json_file(filename, default)
+        if isinstance(snapshot, dict) and set(snapshot.keys()) == {"generation", "records"}:
+            return(snapshot["records"], snapshot["generation"])
+        return(snapshot, 0)
+
+    def read_journal(self, filename):
+        journal = {
+            "users": {},
+            "servers": {},
+            "stats": None,
+        }
+        if not os.path.isfile(filename):
+            return(journal)
+        with open(filename) as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                # The last line might have been cut short by a crash
+                except json.decoder.JSONDecodeError:
+                    logger.warning("Skipping corrupted line in database journal")
+                    continue
+                if entry["type"] == "user":
+                    journal["users"][entry["data"]["oauth_id"]] = entry["data"]
+                elif entry["type"] == "server":
+                    journal["servers"][entry["data"]["name"]] = entry["data"]
+                elif entry["type"] == "stats":
+                    journal["stats"] = entry["data"]
+                self.journal_entries += 1
+        return(journal)
+
+    # Replaces the snapshot records with their latest version from the journal
+    def merge_journal_records(self, serialized_list, journal_records, key):
+        merged_records = {}
+        for record in serialized_list:
+            merged_records[record[key]] = record
+        merged_records.update(journal_records)
+        return(list(merged_records.values()))
+
+
+class SQLiteStorage:
+    # Stores the database in SQLite, in WAL mode, with one row per user and server
+    # The full serialized record is kept as JSON, and the fields we might want to query on get their own indexed columns
+    def __init__(self, filename = "db/horde.db"):
+        self.filename = filename
+        db_dir = os.path.dirname(filename)
+        if db_dir and not os.path.exists(db_dir):
+            os.mkdir(db_dir)
+        # Only the store thread writes after the initial load, so we can share the connection with it
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS users (
+                oauth_id TEXT PRIMARY KEY,
+                id INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                api_key TEXT NOT NULL,
+                kudos REAL NOT NULL,
+                contributions INTEGER NOT NULL,
+                data TEXT NOT NULL
+            )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS users_id ON users (id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS users_api_key ON users (api_key)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS users_kudos ON users (kudos)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS users_contributions ON users (contributions)")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS servers (
+                name TEXT PRIMARY KEY,
+                id TEXT NOT NULL,
+                oauth_id TEXT NOT NULL,
+                model TEXT,
+                contributions INTEGER NOT NULL,
+                last_check_in TEXT,
+                data TEXT NOT NULL
+            )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS servers_id ON servers (id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS servers_oauth_id ON servers (oauth_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS servers_model ON servers (model)")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS stats (
+                key TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            )""")
+
+    def load(self):
+        serialized_users = [json.loads(row[0]) for row in self.conn.execute("SELECT data FROM users ORDER BY id")]
+        serialized_servers = [json.loads(row[0]) for row in self.conn.execute("SELECT data FROM servers")]
+        serialized_stats = None
+        row = self.conn.execute("SELECT data FROM stats WHERE key = 'stats'").fetchone()
+        if row:
+            serialized_stats = json.loads(row[0])
+        return({
+            "users": serialized_users,
+            "servers": serialized_servers,
+            "stats": serialized_stats,
+        })
+
+    # SQLite checkpoints its own WAL, so we never need to compact
+    def needs_compaction(self):
+        return(False)
+
+    # All the changes of one interval go in a single transaction
+    def write_changes(self, serialized_users, serialized_servers, serialized_stats):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO users (oauth_id, id, username, api_key, kudos, contributions, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [self.get_user_row(user_dict) for user_dict in serialized_users]
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO servers (name, id, oauth_id, model, contributions, last_check_in, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [self.get_server_row(server_dict) for server_dict in serialized_servers]
+            )
+            if serialized_stats:
+                self.conn.execute("INSERT OR REPLACE INTO stats (key, data) VALUES ('stats', ?)", (json.dumps(serialized_stats),))
+
+    def write_all(self, serialized_users, serialized_servers, serialized_stats):
+        self.write_changes(serialized_users, serialized_servers, serialized_stats)
+
+    def get_user_row(self, user_dict):
+        return((
+            user_dict["oauth_id"],
+            user_dict["id"],
+            user_dict["username"],
+            user_dict["api_key"],
+            user_dict["kudos"],
+            user_dict["contributions"].get("tokens",0),
+            json.dumps(user_dict),
+        ))
+
+    def get_server_row(self, server_dict):
+        return((
+            server_dict["name"],
+            server_dict["id"],
+            server_dict["oauth_id"],
+            server_dict["model"],
+            server_dict["contributions"],
+            server_dict["last_check_in"],
+            json.dumps(server_dict),
+        ))
+
+
 class Database:
-    def __init__(self, convert_flag = None, interval = 3):
+    def __init__(self, convert_flag = None, interval = 3, storage_type = "json"):
         self.interval = interval
         self.ALLOW_ANONYMOUS = True
         # This is used for synchronous generations
-        self.SERVERS_FILE = "db/servers.json"
         self.servers = {}
         # Other miscellaneous statistics
-        self.STATS_FILE = "db/stats.json"
         self.stats = Stats(self)
-        self.USERS_FILE = "db/users.json"
         self.users = {}
+        # Where we load our records from, and store them to. See get_storage()
+        self.storage = self.get_storage(storage_type)
+        # When converting to SQLite, we load from our JSON files and write everything into the SQLite DB
+        if convert_flag == "to_sqlite":
+            self.storage = JsonStorage()
+        # The records which have changed since we last stored them
+        self.dirty_users = set()
+        self.dirty_servers = set()
+        self.stats_dirty = False
+        # Guards adding to the sets above and swapping them out, so that no change lands in a set we've already taken
+        self.dirty_lock = threading.Lock()
+        # Increment whenever any user, server or the stats change, so that cached responses know when to be rebuilt
+        self.users_version = 0
+        self.servers_version = 0
+        self.stats_version = 0
+        # Secondary indexes, so that request lookups don't need to scan every user or server
+        # They need to be kept in sync via index_user() and index_server()
+        self.users_by_api_key = {}
+        # (username, id) -> user
+        self.users_by_alias = {}
+        self.users_by_id = {}
+        self.servers_by_id = {}
+        # Users and servers sorted by (-kudos, id) and (-contributed tokens, id), so that listings can be paged through
+        # They need to be kept in sync via sort_user() and sort_server()
+        self.users_by_kudos = OrderStatisticTree(0)
+        self.users_by_contributions = OrderStatisticTree(0)
+        self.servers_by_kudos = OrderStatisticTree(0)
+        # Each server also carries its (contributed tokens, fulfilments), so that the horde's totals are always at hand
+        self.servers_by_contributions = OrderStatisticTree(2)
+        # The servers which checked in recently, as id -> the model they were counted under,
+        # along with how many of them serve each model, so that status requests don't need to look at every server.
+        # They're kept in sync via mark_server_active() and mark_server_inactive()
+        self.active_servers = {}
+        self.active_models = {}
+        self.active_servers_lock = threading.Lock()
+        # The active servers sorted the same way as servers_by_kudos and servers_by_contributions, overall and per model,
+        # so that listing active servers only pages through those. Kept in sync via sort_active_server()
+        self.active_servers_by_kudos = OrderStatisticTree(0)
+        self.active_servers_by_contributions = OrderStatisticTree(0)
+        # model -> (by kudos, by contributions)
+        self.active_servers_by_model = {}
+        # Servers which haven't checked in for a long time. They're out of self.servers, so that we don't keep going through them,
+        # but they're still stored, and they come back as soon as they check in again
+        self.cold_servers = {}
         # Increments any time a new user is added
         # Is appended to usernames, to ensure usernames never conflict
         self.last_user_id = 0
+        # Callbacks which need to know when a user's kudos change, such as the prompt queue priority
+        self.kudos_change_callbacks = [self.sort_user]
+        # Guards everyone's kudos and the sorted indexes which follow them. The callbacks above are called while holding it
+        self.kudos_lock = threading.RLock()
         logger.init(f"Database Load", status="Starting")
         if convert_flag:
             logger.init_warn(f"Convert Flag '{convert_flag}' received.", status="Converting")
-        if os.path.isfile(self.USERS_FILE):
-            with open(self.USERS_FILE) as db:
-                serialized_users = json.load(db)
-                for user_dict in serialized_users:
-                    new_user = User(self)
-                    new_user.deserialize(user_dict,convert_flag)
-                    self.users[new_user.oauth_id] = new_user
-                    if new_user.id > self.last_user_id:
-                        self.last_user_id = new_user.id
+        serialized_db = self.storage.load()
+        for user_dict in serialized_db["users"]:
+            new_user = User(self)
+            new_user.deserialize(user_dict,convert_flag)
+            self.users[new_user.oauth_id] = new_user
+            self.index_user(new_user)
+            if new_user.id > self.last_user_id:
+                self.last_user_id = new_user.id
         self.anon = self.find_user_by_oauth_id('anon')
         if not self.anon:
             self.anon = User(self)
             self.anon.create_anon()
             self.users[self.anon.oauth_id] = self.anon
-        if os.path.isfile(self.SERVERS_FILE):
-            with open(self.SERVERS_FILE) as db:
-                serialized_servers = json.load(db)
-                for server_dict in serialized_servers:
-                    new_server = KAIServer(self)
-                    new_server.deserialize(server_dict,convert_flag)
-                    self.servers[new_server.name] = new_server
-        if os.path.isfile(self.STATS_FILE):
-            with open(self.STATS_FILE) as stats_db:
-                self.stats.deserialize(json.load(stats_db),convert_flag)
+            self.index_user(self.anon)
+            self.mark_user_dirty(self.anon)
+        for server_dict in serialized_db["servers"]:
+            new_server = KAIServer(self)
+            new_server.deserialize(server_dict,convert_flag)
+        if serialized_db["stats"]:
+            self.stats.deserialize(serialized_db["stats"],convert_flag)
 
         if convert_flag:
+            if convert_flag == "to_sqlite":
+                self.storage = SQLiteStorage()
             self.write_files_to_disk()
             logger.init_ok(f"Convertion complete.", status="Exiting")
             sys.exit()
+        if self.storage.needs_compaction():
+            self.write_files_to_disk()
+        # Expires stale prompt requests (and their generations) and servers, for the whole horde
+        self.expiry_scheduler = ExpiryScheduler()
+        for server in list(self.servers.values()):
+            if server.is_stale():
+                self.schedule_server_expiry(server)
+            else:
+                self.mark_server_active(server)
         thread = threading.Thread(target=self.write_files, args=())
         thread.daemon = True
         thread.start()
         logger.init_ok(f"Database Load", status="Completed")
 
+    def get_storage(self, storage_type):
+        if storage_type == "sqlite":
+            return(SQLiteStorage())
+        return(JsonStorage())
+
     def write_files(self):
         logger.init_ok("Database Store Thread", status="Started")
         while True:
-            self.write_files_to_disk()
+            self.write_changes()
+            if self.storage.needs_compaction():
+                self.write_files_to_disk()
             time.sleep(self.interval)
 
+    def mark_user_dirty(self, user):
+        with self.dirty_lock:
+            self.dirty_users.add(user)
+            self.users_version += 1
+
+    def mark_server_dirty(self, server):
+        with self.dirty_lock:
+            self.dirty_servers.add(server)
+            self.servers_version += 1
+
+    def mark_stats_dirty(self):
+        with self.dirty_lock:
+            self.stats_dirty = True
+            self.stats_version += 1
+
+    # Returns everything marked dirty so far, and starts over with nothing dirty
+    def take_dirty(self):
+        with self.dirty_lock:
+            dirty_users, self.dirty_users = self.dirty_users, set()
+            dirty_servers, self.dirty_servers = self.dirty_servers, set()
+            stats_dirty, self.stats_dirty = self.stats_dirty, False
+        return(dirty_users, dirty_servers, stats_dirty)
+
+    # Stores every record which changed since the last time
+    @logger.catch
+    def write_changes(self):
+        # We swap the sets first, so that records changed while we're writing are picked up next time
+        dirty_users, dirty_servers, stats_dirty = self.take_dirty()
+        if not dirty_users and not dirty_servers and not stats_dirty:
+            return
+        try:
+            serialized_users = [user.serialize() for user in dirty_users]
+            # We don't store data for anon servers
+            serialized_servers = [server.serialize() for server in dirty_servers if server.user != self.anon]
+            serialized_stats = None
+            if stats_dirty:
+                serialized_stats = self.stats.serialize()
+            self.storage.write_changes(serialized_users, serialized_servers, serialized_stats)
+        except Exception:
+            # So that we try storing them again next time, instead of losing them until the next compaction
+            with self.dirty_lock:
+                self.dirty_users.update(dirty_users)
+                self.dirty_servers.update(dirty_servers)
+                self.stats_dirty = self.stats_dirty or stats_dirty
+            raise
+
+    # Stores every record in full
+    @logger.catch
     def write_files_to_disk(self):
-        if not os.path.exists('db'):
-            os.mkdir('db')
+        # Anything dirty at this point will be stored anyway
+        self.take_dirty()
         server_serialized_list = []
-        for server in self.servers.values():
+        for server in list(self.servers.values()) + list(self.cold_servers.values()):
             # We don't store data for anon servers
             if server.user == self.anon: continue
             server_serialized_list.append(server.serialize())
-        with open(self.SERVERS_FILE, 'w') as db:
-            json.dump(server_serialized_list,db)
-        with open(self.STATS_FILE, 'w') as db:
-            json.dump(self.stats.serialize(),db)
         user_serialized_list = []
-        for user in self.users.values():
+        for user in list(self.users.values()):
             user_serialized_list.append(user.serialize())
-        with open(self.USERS_FILE, 'w') as db:
-            json.dump(user_serialized_list,db)
+        self.storage.write_all(user_serialized_list, server_serialized_list, self.stats.serialize())
+
+    # The users who contributed the most tokens, best first
+    def get_top_contributors(self, count):
+        top_contributors = []
+        with self.kudos_lock:
+            for user in self.users_by_contributions.iter_sorted():
+                if len(top_contributors) >= count or user.contributions['tokens'] <= 0:
+                    break
+                if user == self.anon:
+                    continue
+                top_contributors.append(user)
+        return(top_contributors)
 
     def get_top_contributor(self):
-        top_contribution = 0
-        top_contributor = None
-        user = None
-        for user in self.users.values():
-            if user.contributions['tokens'] > top_contribution and user != self.anon:
-                top_contributor = user
-                top_contribution = user.contributions['tokens']
-        return(top_contributor)
+        top_contributors = self.get_top_contributors(1)
+        if not top_contributors:
+            return(None)
+        return(top_contributors[0])
+
+    # The servers which contributed the most tokens, best first
+    def get_top_servers(self, count):
+        top_servers = []
+        with self.kudos_lock:
+            for server in self.servers_by_contributions.iter_sorted():
+                if len(top_servers) >= count or server.contributions <= 0:
+                    break
+                top_servers.append(server)
+        return(top_servers)
 
     def get_top_server(self):
-        top_server = None
-        top_server_contribution = 0
-        for server in self.servers:
-            if self.servers[server].contributions > top_server_contribution:
-                top_server = self.servers[server]
-                top_server_contribution = self.servers[server].contributions
-        return(top_server)
+        top_servers = self.get_top_servers(1)
+        if not top_servers:
+            return(None)
+        return(top_servers[0])
 
     def get_available_models(self):
-        models_ret = {}
-        for server in self.servers.values():
-            if server.is_stale():
-                continue
-            models_ret[server.model] = models_ret.get(server.model,0) + 1
-        return(models_ret)
+        with self.active_servers_lock:
+            return(dict(self.active_models))
 
     def count_active_servers(self):
-        count = 0
-        for server in self.servers.values():
-            if not server.is_stale():
-                count += 1
-        return(count)
+        return(len(self.active_servers))
+
+    def get_active_servers(self):
+        with self.active_servers_lock:
+            server_ids = list(self.active_servers)
+        return([self.servers_by_id[server_id] for server_id in server_ids])
+
+    def is_server_active(self, server):
+        return(server.id in self.active_servers)
+
+    # Called whenever a server checks in
+    def mark_server_active(self, server):
+        with self.kudos_lock, self.active_servers_lock:
+            counted_model = self.active_servers.get(server.id)
+            if server.id in self.active_servers and counted_model == server.model:
+                return
+            if server.id in self.active_servers:
+                self.count_active_model(counted_model, -1)
+                self.unsort_active_server(server, counted_model)
+            else:
+                # An active server is already scheduled to be checked for when it goes stale
+                self.schedule_server_expiry(server)
+            self.active_servers[server.id] = server.model
+            self.count_active_model(server.model, 1)
+            self.sort_active_server(server, server.model)
+        self.servers_version += 1
+
+    def mark_server_inactive(self, server):
+        with self.kudos_lock, self.active_servers_lock:
+            if server.id not in self.active_servers:
+                return
+            counted_model = self.active_servers.pop(server.id)
+            self.count_active_model(counted_model, -1)
+            self.unsort_active_server(server, counted_model)
+        self.servers_version += 1
+
+    # Needs to be called with kudos_lock held
+    def sort_active_server(self, server, model):
+        if model not in self.active_servers_by_model:
+            self.active_servers_by_model[model] = (OrderStatisticTree(0), OrderStatisticTree(0))
+        model_by_kudos, model_by_contributions = self.active_servers_by_model[model]
+        for by_kudos, by_contributions in ((self.active_servers_by_kudos, self.active_servers_by_contributions), (model_by_kudos, model_by_contributions)):
+            by_kudos.insert(server, (-server.kudos, server.id), ())
+            by_contributions.insert(server, (-server.contributions, server.id), ())
+
+    # Needs to be called with kudos_lock held
+    def unsort_active_server(self, server, model):
+        self.active_servers_by_kudos.remove(server)
+        self.active_servers_by_contributions.remove(server)
+        model_by_kudos, model_by_contributions = self.active_servers_by_model[model]
+        model_by_kudos.remove(server)
+        model_by_contributions.remove(server)
+        if not len(model_by_kudos):
+            del self.active_servers_by_model[model]
+
+    # Returns the sorted index to list servers from. If only active servers are wanted, only those are in it,
+    # and the same for a model. Servers from the whole index are still to be filtered on the model if inactive ones are wanted
+    def get_server_sort_index(self, sort, active = True, model = None):
+        if not active:
+            if sort == "contributions":
+                return(self.servers_by_contributions)
+            return(self.servers_by_kudos)
+        sort_position = 1 if sort == "contributions" else 0
+        if model:
+            with self.kudos_lock:
+                if model not in self.active_servers_by_model:
+                    return(OrderStatisticTree(0))
+                return(self.active_servers_by_model[model][sort_position])
+        return((self.active_servers_by_kudos, self.active_servers_by_contributions)[sort_position])
+
+    # Needs to be called with active_servers_lock held
+    def count_active_model(self, model, change):
+        self.active_models[model] = self.active_models.get(model, 0) + change
+        if self.active_models[model] <= 0:
+            del self.active_models[model]
+
+    def schedule_server_expiry(self, server):
+        server.expiry = ServerExpiry(server)
+        self.expiry_scheduler.schedule(server.expiry, server.get_expiry_time())
+
+    def move_server_to_cold_storage(self, server):
+        if self.servers.get(server.name) != server:
+            return
+        del self.servers[server.name]
+        self.cold_servers[server.name] = server
+        logger.debug(f"Server '{server.name}' moved to cold storage")
 
     def get_total_usage(self):
+        with self.kudos_lock:
+            tokens, fulfilments = self.servers_by_contributions.get_totals()
         totals = {
-            "tokens": 0,
-            "fulfilments": 0,
+            "tokens": tokens,
+            "fulfilments": fulfilments,
         }
-        for server in self.servers.values():
-            totals["tokens"] += server.contributions
-            totals["fulfilments"] += server.fulfilments
         return(totals)
 
     def register_new_user(self, user):
         self.last_user_id += 1
+        user.id = self.last_user_id
         self.users[user.oauth_id] = user
+        self.index_user(user)
+        self.mark_user_dirty(user)
         logger.info(f'New user created: {user.username}#{self.last_user_id}')
         return(self.last_user_id)
 
     def register_new_server(self, server):
-        self.servers[server.name] = server
+        self.index_server(server)
+        self.mark_server_dirty(server)
         logger.info(f'New server checked-in: {server.name} by {server.user.get_unique_alias()}')
 
+    # Hands out the kudos of claimed generations. They're added up first, so that each server and user
+    # is modified and re-sorted once per batch instead of once per generation
+    def reward_generations(self, procgens):
+        servers = {}
+        contributors = {}
+        requesters = {}
+        for procgen in procgens:
+            server_totals = servers.setdefault(procgen.server, {"tokens": 0, "kudos": 0, "performances": []})
+            server_totals["tokens"] += procgen.tokens
+            server_totals["kudos"] += procgen.kudos
+            server_totals["performances"].append(procgen.tokens_per_sec)
+            contributor_totals = contributors.setdefault(procgen.server.user, {"tokens": 0, "kudos": 0, "count": 0})
+            requester_totals = requesters.setdefault(procgen.owner.user, {"tokens": 0, "kudos": 0, "count": 0})
+            for totals in (contributor_totals, requester_totals):
+                totals["tokens"] += procgen.tokens
+                totals["kudos"] += procgen.kudos
+                totals["count"] += 1
+        with self.kudos_lock:
+            for server, totals in servers.items():
+                server.record_contribution(totals["tokens"], round(totals["kudos"], 2), totals["performances"])
+            for user, totals in contributors.items():
+                user.record_contributions(totals["tokens"], round(totals["kudos"], 2), totals["count"])
+            for user, totals in requesters.items():
+                user.record_usage(totals["tokens"], round(totals["kudos"], 2), totals["count"])
+        for procgen in procgens:
+            procgen.owner.refresh()
+            # If the model's multiplier was only provisional, these kudos will be corrected once it's resolved
+            self.stats.track_reward(procgen.model, procgen.multiplier, procgen.kudos, procgen.server, 'generated', procgen.owner.user)
+            logger.info(f"New Generation worth {procgen.kudos} kudos, delivered by server: {procgen.server.name}")
+            procgen.owner.check_completion()
+
+    def register_kudos_change_callback(self, callback):
+        self.kudos_change_callbacks.append(callback)
+
+    def notify_kudos_change(self, user):
+        for callback in self.kudos_change_callbacks:
+            callback(user)
+
     def find_user_by_oauth_id(self,oauth_id):
         if oauth_id == 'anon' and not self.ALLOW_ANONYMOUS:
             return(None)
         return(self.users.get(oauth_id))
 
+    def index_user(self, user):
+        self.users_by_api_key[user.api_key] = user
+        self.users_by_alias[(user.username, user.id)] = user
+        self.users_by_id[user.id] = user
+        self.sort_user(user)
+
+    # Contributions only change along with kudos, so this is called whenever the user's kudos change
+    def sort_user(self, user):
+        with self.kudos_lock:
+            self.users_by_kudos.insert(user, (-user.kudos, user.id), ())
+            self.users_by_contributions.insert(user, (-user.contributions["tokens"], user.id), ())
+
+    # Used when a user's username or API key changes, so that the indexes point to the new values
+    def reindex_user(self, user, old_username, old_api_key):
+        if self.users_by_api_key.get(old_api_key) == user:
+            del self.users_by_api_key[old_api_key]
+        if self.users_by_alias.get((old_username, user.id)) == user:
+            del self.users_by_alias[(old_username, user.id)]
+        self.index_user(user)
+        self.mark_user_dirty(user)
+
+    def index_server(self, server):
+        self.servers[server.name] = server
+        self.servers_by_id[server.id] = server
+        self.sort_server(server)
+
+    # Contributions only change along with kudos, so this is called whenever the server's kudos change
+    def sort_server(self, server):
+        with self.kudos_lock:
+            self.servers_by_kudos.insert(server, (-server.kudos, server.id), ())
+            self.servers_by_contributions.insert(server, (-server.contributions, server.id), (server.contributions, server.fulfilments))
+            if server.id in self.active_servers:
+                self.sort_active_server(server, self.active_servers[server.id])
+
+    # Returns up to limit items from one of our sorted indexes, starting after the provided key,
+    # along with the key to continue from for the next page, or None if there's nothing more.
+    # Items for which accept() returns False are skipped.
+    def get_sorted_page(self, sorted_index, after_key, limit, accept = None):
+        items = []
+        last_key = None
+        with self.kudos_lock:
+            for key, item in sorted_index.iter_sorted_with_keys(after_key):
+                if accept is not None and not accept(item):
+                    continue
+                if len(items) >= limit:
+                    return(items, last_key)
+                items.append(item)
+                last_key = key
+        return(items, None)
+
     def find_user_by_username(self, username):
-        for user in self.users.values():
-            uniq_username = username.split('#')
-            if user.username == uniq_username[0] and user.id == int(uniq_username[1]):
-                if user == self.anon and not self.ALLOW_ANONYMOUS:
-                    return(None)
-                return(user)
-        return(None)
+        uniq_username = username.rsplit('#',1)
+        if len(uniq_username) != 2 or not uniq_username[1].isdigit():
+            return(None)
+        user = self.users_by_alias.get((uniq_username[0], int(uniq_username[1])))
+        if user == self.anon and not self.ALLOW_ANONYMOUS:
+            return(None)
+        return(user)
 
     def find_user_by_api_key(self,api_key):
-        for user in self.users.values():
-            if user.api_key == api_key:
-                if user == self.anon and not self.ALLOW_ANONYMOUS:
-                    return(None)
-                return(user)
-        return(None)
+        user = self.users_by_api_key.get(api_key)
+        if user == self.anon and not self.ALLOW_ANONYMOUS:
+            return(None)
+        return(user)
+
+    def find_user_by_id(self, user_id):
+        user = self.users_by_id.get(user_id)
+        if user == self.anon and not self.ALLOW_ANONYMOUS:
+            return(None)
+        return(user)
 
     def find_server_by_name(self,server_name):
-        return(self.servers.get(server_name))
+        server = self.servers.get(server_name)
+        if server:
+            return(server)
+        # Any lookup by name might be the server checking in again, so we bring it back from cold storage
+        server = self.cold_servers.pop(server_name, None)
+        if server:
+            self.servers[server_name] = server
+            # If it doesn't check in after all, it goes back once its deadline comes again
+            self.schedule_server_expiry(server)
+        return(server)
+
+    def find_server_by_id(self,server_id):
+        return(self.servers_by_id.get(server_id))
 
     def transfer_kudos(self, source_user, dest_user, amount):
-        if amount > source_user.kudos:
-            return([0,'Not enough kudos.'])
-        source_user.modify_kudos(-amount, 'gifted')
-        dest_user.modify_kudos(amount, 'received')
+        # So that two transfers can't both spend the same kudos
+        with self.kudos_lock:
+            if amount > source_user.kudos:
+                return([0,'Not enough kudos.'])
+            source_user.modify_kudos(-amount, 'gifted')
+            dest_user.modify_kudos(amount, 'received')
         return([amount,'OK'])
 
     def transfer_kudos_to_username(self, source_user, dest_username, amount):
@@ -839,8 +2459,9 @@ class Database:
         kudos = self.transfer_kudos_to_username(source_user, dest_username, amount)
         return(kudos)
 
-    def convert_tokens_to_kudos(self, tokens, model_name):
-        multiplier = self.stats.calculate_model_multiplier(model_name)
+    def convert_tokens_to_kudos(self, tokens, model_name, multiplier = None):
+        if multiplier is None:
+            multiplier = self.stats.calculate_model_multiplier(model_name)
         # We want a 2.7B model at 80 tokens to be worth around 10 kudos
         kudos = round(tokens * multiplier / 21, 2)
         # logger.info([tokens,multiplier,kudos])
@@ -0,0 +1,13 @@
+import os, sys, tempfile
+
+import pytest
+
+# The horde's modules live in the repository root, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# The database keeps storing itself under db/ in the working directory from its own thread, even after a test is done with it,
+# so the whole session runs in a temporary directory, and we never go back to the repository while those threads are alive
+@pytest.fixture(scope = "session", autouse = True)
+def working_directory():
+    os.chdir(tempfile.mkdtemp(prefix = "horde-tests-"))
@@ -0,0 +1,116 @@
+import random, sys, threading
+from collections import Counter
+
+import pytest
+
+import server
+from server_classes import Database, PromptsIndex, GenerationsIndex, WaitingPrompt, KAIServer, User
+
+POPPERS = 32
+WAITING_PROMPTS = 400
+
+
+@pytest.fixture
+def horde(monkeypatch):
+    # The database stores itself under db/ in the working directory, which conftest.py keeps out of the repository
+    db = Database()
+    waiting_prompts = PromptsIndex()
+    processing_generations = GenerationsIndex()
+    db.register_kudos_change_callback(waiting_prompts.update_user_priority)
+    db.stats.model_mulitpliers['test-model'] = 1
+    monkeypatch.setattr(server, "_db", db, raising = False)
+    monkeypatch.setattr(server, "_waiting_prompts", waiting_prompts, raising = False)
+    monkeypatch.setattr(server, "_processing_generations", processing_generations, raising = False)
+    # Switching threads as often as possible makes races far more likely to show up
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield(db, waiting_prompts, processing_generations)
+    sys.setswitchinterval(switch_interval)
+
+
+def create_user(db, name):
+    user = User(db)
+    user.create(name, f"oauth_{name}", f"api_key_{name}", None)
+    return(user)
+
+
+def test_no_double_dispatch(horde):
+    db, waiting_prompts, processing_generations = horde
+    random.seed(0)
+    users = [create_user(db, f"user{i}") for i in range(10)]
+    for user in users:
+        user.modify_kudos(random.randint(0, 500), 'accumulated')
+    servers = []
+    for i in range(POPPERS):
+        kai_server = KAIServer(db)
+        kai_server.create(users[i % len(users)], f"server{i}", [])
+        # Half of them report a loaded softprompt, so that the affinity path is exercised as well
+        kai_server.check_in("test-model", 80, 1024, [], current_softprompt = '' if i % 2 else None)
+        servers.append(kai_server)
+    expected_jobs = 0
+    # The WPs change their params into the payload sent to KoboldAI, so we keep how many gens each asked for here
+    requested_gens = {}
+    for i in range(WAITING_PROMPTS):
+        n = random.randint(1, 5)
+        expected_jobs += n
+        wp = WaitingPrompt(db, waiting_prompts, processing_generations, "prompt", users[i % len(users)], ["test-model"], {"n": n, "max_length": 10})
+        requested_gens[wp] = n
+        wp.activate()
+
+    pop = server.PromptPop()
+    job_ids = []
+    rewards = []
+    errors = []
+    # WPs which still needed gens when a popper was sent away empty-handed
+    left_behind = []
+    results_lock = threading.Lock()
+
+    def submit(procgen):
+        kudos = procgen.set_generation("generated text")
+        with results_lock:
+            rewards.append((procgen.id, kudos))
+
+    def popper(kai_server, max_jobs):
+        try:
+            while True:
+                jobs, skipped = pop.pop_matching_wps(kai_server, [users[0]], [], max_jobs)
+                if not jobs:
+                    # Gens are only ever claimed, so any WP still needing one now needed it during the pop as well
+                    with results_lock:
+                        left_behind.extend(wp for wp in requested_gens if wp.needs_gen())
+                    return
+                with results_lock:
+                    job_ids.extend(job["id"] for job in jobs)
+                # Every generation is submitted twice at the same time, and must only be rewarded once
+                for job in jobs:
+                    procgen = processing_generations.get_item(job["id"])
+                    submitters = [threading.Thread(target = submit, args = (procgen,)) for _ in range(2)]
+                    for submitter in submitters:
+                        submitter.start()
+                    for submitter in submitters:
+                        submitter.join()
+        except Exception as e:
+            errors.append(e)
+            raise
+
+    threads = [threading.Thread(target = popper, args = (kai_server, random.randint(2, 4))) for kai_server in servers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    # Every server can do every WP, so none of them may be told there's nothing to do while there's still work queued
+    assert left_behind == []
+    assert len(job_ids) == len(set(job_ids))
+    assert len(job_ids) == expected_jobs
+    # Each WP handed out exactly as many gens as it asked for
+    gens_per_wp = Counter(processing_generations.get_item(job_id).owner for job_id in job_ids)
+    for wp, n in requested_gens.items():
+        assert gens_per_wp[wp] == len(wp.processing_gens) == n
+        assert wp.is_completed()
+    rewarded = Counter(procgen_id for procgen_id, kudos in rewards if kudos)
+    assert set(rewarded) == set(job_ids)
+    assert all(count == 1 for count in rewarded.values())
+    assert waiting_prompts.count_totals() == {"queued_requests": 0, "queued_tokens": 0}
+    assert sum(kai_server.fulfilments for kai_server in servers) == expected_jobs
@@ -0,0 +1,139 @@
+import json, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from server_classes import WebhookDispatcher
+
+
+# A local HTTP stand-in for the receiving end of the webhooks.
+# It answers with the next status in statuses for every POST, and keeps the payloads and times it received
+class Receiver:
+    def __init__(self, statuses = None, redirect_to = None):
+        self.statuses = list(statuses or [])
+        self.redirect_to = redirect_to
+        self.received = []
+        self.times = []
+        self.delivered = threading.Event()
+        receiver = self
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                receiver.received.append(json.loads(body))
+                receiver.times.append(time.time())
+                status = receiver.statuses.pop(0) if receiver.statuses else 200
+                self.send_response(status)
+                if receiver.redirect_to:
+                    self.send_header('Location', receiver.redirect_to)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                if status < 300:
+                    receiver.delivered.set()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/hook"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+
+
+@pytest.fixture
+def dead_letter_file(tmp_path):
+    return(str(tmp_path / "dead_letters.jsonl"))
+
+
+def wait_for(condition, timeout = 5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return(True)
+        time.sleep(0.01)
+    return(False)
+
+
+def test_delivers_payload(dead_letter_file):
+    receiver = Receiver()
+    webhooks = WebhookDispatcher(workers = 1, dead_letter_file = dead_letter_file, allow_private_hosts = True)
+    webhooks.send(receiver.url, {"id": "wp1", "generations": [{"text": "hello"}]})
+    assert receiver.delivered.wait(5)
+    assert receiver.received == [{"id": "wp1", "generations": [{"text": "hello"}]}]
+    receiver.close()
+
+
+def test_retries_with_backoff(dead_letter_file):
+    receiver = Receiver(statuses = [500, 503])
+    webhooks = WebhookDispatcher(workers = 1, max_attempts = 5, backoff = 1.5, dead_letter_file = dead_letter_file, allow_private_hosts = True)
+    webhooks.send(receiver.url, {"id": "wp1"})
+    assert receiver.delivered.wait(10)
+    assert len(receiver.received) == 3
+    # The first retry comes backoff^1 seconds after the first attempt, and the next one backoff^2 after that
+    assert receiver.times[1] - receiver.times[0] >= 1.5 - 0.05
+    assert receiver.times[2] - receiver.times[1] >= 1.5 ** 2 - 0.05
+    assert wait_for(lambda: webhooks.count_pending() == 0)
+    receiver.close()
+
+
+def test_gives_up_into_dead_letters(dead_letter_file):
+    receiver = Receiver(statuses = [500] * 10)
+    webhooks = WebhookDispatcher(workers = 1, max_attempts = 3, backoff = 0.1, dead_letter_file = dead_letter_file, allow_private_hosts = True)
+    webhooks.send(receiver.url, {"id": "wp1"})
+    assert wait_for(lambda: webhooks.count_dead_letters() == 1)
+    assert len(receiver.received) == 3
+    with open(dead_letter_file) as f:
+        dead_letters = [json.loads(line) for line in f]
+    assert len(dead_letters) == 1
+    assert dead_letters[0]["url"] == receiver.url
+    assert dead_letters[0]["payload"] == {"id": "wp1"}
+    assert dead_letters[0]["attempts"] == 3
+    assert dead_letters[0]["error"] == "status 500"
+    receiver.close()
+
+
+def test_does_not_follow_redirects(dead_letter_file):
+    target = Receiver()
+    receiver = Receiver(statuses = [302] * 10, redirect_to = target.url)
+    webhooks = WebhookDispatcher(workers = 1, max_attempts = 2, backoff = 0.1, dead_letter_file = dead_letter_file, allow_private_hosts = True)
+    webhooks.send(receiver.url, {"id": "wp1"})
+    assert wait_for(lambda: webhooks.count_dead_letters() == 1)
+    assert len(receiver.received) == 2
+    assert target.received == []
+    receiver.close()
+    target.close()
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1:5001/hook",
+    "http://localhost/hook",
+    "http://169.254.169.254/latest/meta-data",
+    "http://10.0.0.1/hook",
+    "http://192.168.1.10/hook",
+    "http://172.16.0.1/hook",
+    "http://[::1]/hook",
+    "http://[::ffff:127.0.0.1]/hook",
+    "http://0.0.0.0/hook",
+    "http://240.0.0.1/hook",
+    "ftp://93.184.216.34/hook",
+    "not a url",
+])
+def test_rejects_internal_urls(url, dead_letter_file):
+    webhooks = WebhookDispatcher(workers = 0, dead_letter_file = dead_letter_file)
+    assert not webhooks.is_allowed_url(url)
+
+
+def test_accepts_public_urls(dead_letter_file):
+    webhooks = WebhookDispatcher(workers = 0, dead_letter_file = dead_letter_file)
+    assert webhooks.is_allowed_url("https://93.184.216.34/hook")
+    assert webhooks.is_allowed_url("http://[2606:4700::1111]:8080/hook")
+
+
+def test_never_delivers_to_internal_hosts(dead_letter_file):
+    receiver = Receiver()
+    webhooks = WebhookDispatcher(workers = 1, dead_letter_file = dead_letter_file)
+    webhooks.send(receiver.url, {"id": "wp1"})
+    assert wait_for(lambda: webhooks.count_dead_letters() == 1)
+    assert receiver.received == []
+    with open(dead_letter_file) as f:
+        assert json.loads(f.readline())["error"] == "forbidden host"
+    receiver.close()